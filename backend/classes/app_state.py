@@ -0,0 +1,121 @@
+import threading
+import time
+
+from classes.store import Store, StoresRankings, get_all_stores
+from classes.geocoding import GeocodeCache, OfflineGeocoder, cached_geocoder, make_geocoder, set_default_geocoder
+from classes.id_allocator import IdAllocator
+from classes.cache import TTLCache
+from classes.metrics import Metrics
+from classes.profiling import RequestProfiler
+
+
+class AppState:
+    # everything one server process keeps between requests; every worker builds its own
+    def __init__(self, config, database = None):
+        # nothing is connected or loaded here, start() does it when the first request comes
+        self.config = config
+        self.database = database
+        self.started = False
+        self.start_lock = threading.Lock()
+        self.store_ids = IdAllocator("stores")
+        self.metrics = Metrics()
+        self.profiler = RequestProfiler(config["PROFILE_DIR"], config["PROFILE_SAMPLE_RATE"],
+                                        config["PROFILE_TOKEN"], config["PROFILE_MAX_FILES"])
+        # serialized responses of the read endpoints, keyed by request and data version
+        self.responses = TTLCache(config["RESPONSE_CACHE_SIZE"], config["RESPONSE_CACHE_SECONDS"])
+
+        self.rankings_lock = threading.Lock()
+        self.rankings = None
+        self.rankings_loaded = 0
+
+        self.catalog_lock = threading.Lock()
+        self.catalog = None
+        self.snapshot = None
+
+    def start(self):
+        # called before every request, the lock is only taken until the first start has finished
+        if self.started:
+            return
+        with self.start_lock:
+            if self.started:
+                return
+            if self.database == None:
+                from classes.database_interface import DatabaseInterface
+                self.database = DatabaseInterface(self.config["DB_URL"], self.config["DB_NAME"], metrics=self.metrics)
+            set_default_geocoder(cached_geocoder(make_geocoder(self.config["GEOCODER"]), self.database))
+
+            # raises while a unique index is missing, so no request is served until the duplicates are gone
+            self.database.ensure_indexes()
+            self.database.require_unique_indexes()
+            self.database.fill_store_places()
+            self.database.fill_product_places()
+
+            # new ids continue above the highest id handed out before the counter existed
+            max_store_id = self.database.get_max_store_id()
+            self.database.seed_counter("stores", 0 if max_store_id == None else max_store_id + 1)
+            self.started = True
+
+    def get_rankings(self) -> StoresRankings:
+        # other workers change points too, so the ranking is reloaded once it gets old
+        with self.rankings_lock:
+            now = time.monotonic()
+            if self.rankings == None or now - self.rankings_loaded > self.config["RANKING_REFRESH_SECONDS"]:
+                # the version keeps growing across reloads, cached ranking responses never come back
+                version = 0 if self.rankings == None else self.rankings.version + 1
+                self.rankings = StoresRankings(get_all_stores(self.database), version)
+                self.rankings_loaded = now
+            return self.rankings
+
+    def get_catalog(self):
+        # built on first use, numpy is not loaded by workers that never serve /best-deals
+        with self.catalog_lock:
+            if self.catalog == None:
+                from classes.catalog import LiveCatalog
+                self.catalog = LiveCatalog(self.database)
+                self.database.product_listeners.append(self.catalog.products_changed)
+            return self.catalog
+
+    def get_snapshot(self):
+        # the products snapshot shared with the other workers, None when it is off or too far behind the database
+        if self.config["CATALOG_SNAPSHOT_PATH"] == None:
+            return None
+        with self.catalog_lock:
+            if self.snapshot == None:
+                from classes.catalog_snapshot import SharedSnapshot
+                self.snapshot = SharedSnapshot(self.config["CATALOG_SNAPSHOT_PATH"], self.database,
+                                               self.config["CATALOG_SNAPSHOT_REFRESH_SECONDS"],
+                                               self.config["CATALOG_SNAPSHOT_MAX_LAG_SECONDS"])
+        return self.snapshot.current()
+
+
+class AsyncAppState:
+    # AppState for async_server.py, the database calls are awaited in start()
+    def __init__(self, config, database = None):
+        import asyncio
+        self.config = config
+        if database == None:
+            from classes.async_database_interface import AsyncDatabaseInterface
+            database = AsyncDatabaseInterface(config["DB_URL"], config["DB_NAME"])
+        self.database = database
+        # the offline gazetteer answers from memory, so it does not block the event loop
+        set_default_geocoder(GeocodeCache(OfflineGeocoder()))
+        self.store_ids = IdAllocator("stores")
+
+        self.rankings_lock = asyncio.Lock()
+        self.rankings = None
+        self.rankings_loaded = 0
+
+    async def start(self):
+        await self.database.ensure_indexes()
+        await self.database.require_unique_indexes()
+        max_store_id = await self.database.get_max_store_id()
+        await self.database.seed_counter("stores", 0 if max_store_id == None else max_store_id + 1)
+
+    async def get_rankings(self) -> StoresRankings:
+        async with self.rankings_lock:
+            now = time.monotonic()
+            if self.rankings == None or now - self.rankings_loaded > self.config["RANKING_REFRESH_SECONDS"]:
+                stores = [Store.from_database(s) for s in await self.database.get_all_stores()]
+                self.rankings = StoresRankings(stores)
+                self.rankings_loaded = now
+            return self.rankings
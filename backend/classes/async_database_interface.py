@@ -0,0 +1,345 @@
+import asyncio
+import logging
+
+import pymongo
+from pymongo import AsyncMongoClient
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from classes.cache import TTLCache
+from classes.database_interface import (ENTITY_CACHES, INDEXES, OBSOLETE_INDEXES, VERSIONED_COLLECTIONS,
+                                        MissingIndexes, PurchaseAborted, geo_near_unavailable, has_index,
+                                        nearest_products, next_username, products_near_pipeline,
+                                        products_projection, products_query, purchase_points, unique_indexes,
+                                        username_suffix_query)
+from classes.user import User
+from classes.store import Store
+from classes.qr_codes import QR_code
+
+logger = logging.getLogger(__name__)
+
+
+async def abort_purchase(session, undo, error : str):
+    # abort_purchase of database_interface for the async collections
+    if session == None:
+        for collection, query, update in undo:
+            await collection.update_one(query, update)
+    raise PurchaseAborted(error)
+
+
+class AsyncDatabaseInterface:
+    # asyncio counterpart of DatabaseInterface with the same method names, for async_server.py
+    def __init__(self, host : str, database_name : str, cache_settings = ENTITY_CACHES):
+        self.client = AsyncMongoClient(host)
+        self.database = self.client[database_name]
+        self.cache_keys = {}
+        self.caches = {}
+        for collection_name, (key_field, maxsize, ttl) in cache_settings.items():
+            self.cache_keys[collection_name] = key_field
+            self.caches[collection_name] = TTLCache(maxsize, ttl)
+        # called with the changed product ids and the version they produced, see products_changed
+        self.product_listeners = []
+
+    async def find_one_cached(self, collection_name : str, key):
+        cache = self.caches.get(collection_name)
+        if cache != None:
+            doc = cache.get(key)
+            if doc != None:
+                return dict(doc)
+        found = await self.find(collection_name, {self.cache_keys.get(collection_name, "id") : key})
+        if len(found) == 0:
+            return None
+        if cache != None:
+            cache.set(key, found[0])
+        return dict(found[0])
+
+    def invalidate(self, collection_name : str, key = None):
+        cache = self.caches.get(collection_name)
+        if cache == None:
+            return
+        if key == None:
+            cache.clear()
+        else:
+            cache.invalidate(key)
+
+    def get_cache_stats(self):
+        return {name : cache.get_stats() for name, cache in self.caches.items()}
+
+    async def add(self, record : dict, collection_name : str):
+        await self.database[collection_name].insert_one(record)
+
+    async def find(self, collection_name : str, query):
+        try:
+            return await self.database[collection_name].find(query).to_list()
+        except Exception as e:
+            logger.warning("find on %s failed: %s", collection_name, e)
+            return []
+
+    async def add_user(self, user : User) -> User:
+        base = user.username
+        user_dict = user.prepare_dict()
+        done = False
+        while not done:
+            try:
+                await self.add(user_dict, "users")
+                done = True
+            except DuplicateKeyError:
+                user_dict.pop("_id", None)
+                taken = await self.database["users"].find(username_suffix_query(base),
+                                                          {"_id": 0, "username": 1}).to_list()
+                user_dict["username"] = next_username(base, [found["username"] for found in taken])
+        user.username = user_dict["username"]
+        self.invalidate("users", user.username)
+        return user
+
+    async def add_store(self, store : Store):
+        await self.add(store.prepare_dict(), "stores")
+        self.invalidate("stores", store.id)
+        await self.bump_version("stores")
+
+    async def get_user(self, username):
+        user_raw = await self.find_one_cached("users", username)
+        if user_raw == None:
+            return None
+        return User.from_database(user_raw)
+
+    async def get_all_stores(self):
+        return await self.find("stores", {})
+
+    async def get_store(self, id) -> Store:
+        store_raw = await self.find_one_cached("stores", id)
+        if store_raw == None:
+            return None
+        return Store.from_database(store_raw)
+
+    async def get_stores(self, ids) -> dict:
+        stores = {}
+        for store_raw in await self.find("stores", {"id" : {"$in" : list(ids)}}):
+            self.caches["stores"].set(store_raw["id"], store_raw)
+            stores[store_raw["id"]] = Store.from_database(store_raw)
+        return stores
+
+    async def get_max_store_id(self):
+        found = await self.database["stores"].find({}, {"id": 1}).sort("id", pymongo.DESCENDING).limit(1).to_list()
+        if len(found) == 0:
+            return None
+        return found[0]["id"]
+
+    async def seed_counter(self, name : str, minimum : int):
+        await self.database["counters"].update_one({"_id": name}, {"$max": {"value": minimum}}, upsert=True)
+
+    async def bump_version(self, collection_name : str):
+        # the same counters as DatabaseInterface, so sync workers sharing the database see async writes
+        if collection_name not in VERSIONED_COLLECTIONS:
+            return None
+        counter = await self.database["counters"].find_one_and_update(
+            {"_id": "version_" + collection_name}, {"$inc": {"value": 1}},
+            upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        return counter["value"]
+
+    async def products_changed(self, ids):
+        version = await self.bump_version("products")
+        for listener in self.product_listeners:
+            listener(ids, version)
+
+    async def get_version(self, collection_name : str) -> int:
+        counter = await self.database["counters"].find_one({"_id": "version_" + collection_name})
+        if counter == None:
+            return 0
+        return counter["value"]
+
+    async def lease_ids(self, name : str, count : int) -> int:
+        counter = await self.database["counters"].find_one_and_update(
+            {"_id": name},
+            {"$inc": {"value": count}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        return counter["value"]
+
+    async def update_prod_quantity(self, product, addition = True):
+        collection = self.database["products"]
+        if addition:
+            await collection.update_one({"id": product.id}, {"$inc": {"quantity": product.quantity}})
+        elif product.quantity == 0:
+            await collection.delete_one({"id": product.id})
+        else:
+            await collection.update_one({"id": product.id}, {"$set": {"quantity": product.quantity}})
+        self.invalidate("products", product.id)
+        await self.products_changed([product.id])
+
+    async def add_product(self, product):
+        try:
+            await self.add(product.prepare_dict(), "products")
+            self.invalidate("products", product.id)
+            await self.products_changed([product.id])
+        except DuplicateKeyError:
+            await self.update_prod_quantity(product)
+
+    async def delete(self, collection_name, query):
+        await self.database[collection_name].delete_many(query)
+        key_field = self.cache_keys.get(collection_name)
+        if list(query.keys()) == [key_field] and not isinstance(query[key_field], dict):
+            self.invalidate(collection_name, query[key_field])
+            changed = [query[key_field]]
+        else:
+            self.invalidate(collection_name)
+            changed = None
+        if collection_name == "products":
+            await self.products_changed(changed)
+        else:
+            await self.bump_version(collection_name)
+
+    async def add_qr_code(self, code : QR_code):
+        try:
+            await self.add(code.prepare_dict(), "qr_codes")
+        except DuplicateKeyError:
+            pass
+
+    async def get_user_from_qr_code(self, code_raw : str) -> User:
+        code_found = await self.find("qr_codes", {"code" : code_raw})
+        if len(code_found) == 0:
+            return None
+        return await self.get_user(code_found[0]["user"])
+
+    async def get_product(self, product_id):
+        from classes.product import Product
+        raw_product = await self.find_one_cached("products", product_id)
+        if raw_product == None:
+            return None
+        store = await self.get_store(raw_product["store_id"])
+        return Product.from_database(raw_product, self, store)
+
+    async def ensure_indexes(self, indexes = INDEXES, obsolete = OBSOLETE_INDEXES):
+        for collection_name, collection_indexes in obsolete.items():
+            for keys in collection_indexes:
+                try:
+                    await self.database[collection_name].drop_index(keys)
+                except OperationFailure:
+                    pass
+        failed = []
+        for collection_name, collection_indexes in indexes.items():
+            collection = self.database[collection_name]
+            for keys, options in collection_indexes:
+                try:
+                    try:
+                        await collection.create_index(keys, **options)
+                    except OperationFailure as e:
+                        if e.code not in (85, 86):
+                            raise
+                        await collection.drop_index(keys)
+                        await collection.create_index(keys, **options)
+                except Exception as e:
+                    logger.error("Cannot create index %s on %s: %s", keys, collection_name, e)
+                    failed.append((collection_name, keys))
+        return failed
+
+    async def missing_indexes(self, indexes = INDEXES):
+        missing = []
+        for collection_name, collection_indexes in indexes.items():
+            existing = list((await self.database[collection_name].index_information()).values())
+            for keys, options in collection_indexes:
+                if not has_index(existing, keys, options):
+                    missing.append((collection_name, keys))
+        return missing
+
+    async def require_unique_indexes(self):
+        missing = await self.missing_indexes(unique_indexes())
+        if len(missing) > 0:
+            raise MissingIndexes(missing)
+
+    def products_query(self, **filters):
+        return products_query(**filters)
+
+    async def find_products(self, query = None, limit = None, after = None, fields = None):
+        query = dict(query or {})
+        if after != None:
+            query["id"] = {"$gt": after}
+        cursor = self.database["products"].find(query, products_projection(fields)).sort("id", pymongo.ASCENDING)
+        if limit != None:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list()
+
+    async def find_products_near(self, lat, lon, radius_km, limit, by_score = False, query = None):
+        try:
+            pipeline = products_near_pipeline(lat, lon, radius_km, limit, by_score, query)
+            cursor = await self.database["products"].aggregate(pipeline)
+            return await cursor.to_list()
+        except (OperationFailure, NotImplementedError) as e:
+            if not geo_near_unavailable(e):
+                raise
+            products = await self.database["products"].find(query or {}, {"_id": 0, "geo": 0}).to_list()
+            return nearest_products(products, lat, lon, radius_km, limit, by_score)
+
+    def supports_transactions(self):
+        return self.client.topology_description.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+
+    async def purchase(self, code_raw : str, product_id, quantity : int):
+        code_found = await self.find("qr_codes", {"code" : code_raw})
+        if len(code_found) == 0:
+            return {"error" : "user_not_existing"}
+        username = code_found[0]["user"]
+
+        async def apply(session):
+            product_raw = await self.database["products"].find_one_and_update(
+                {"id": product_id, "quantity": {"$gte": quantity}},
+                {"$inc": {"quantity": -quantity}},
+                return_document=pymongo.ReturnDocument.AFTER,
+                session=session
+            )
+            if product_raw == None:
+                if await self.database["products"].find_one({"id": product_id}, session=session) == None:
+                    return {"error" : "product_not_existing"}
+                return {"error" : "not_enough_quantity"}
+
+            user_points, store_points = purchase_points(product_raw, quantity)
+            updates = [
+                self.database["users"].find_one_and_update(
+                    {"username": username},
+                    {"$inc": {"points": user_points}},
+                    return_document=pymongo.ReturnDocument.AFTER,
+                    session=session
+                ),
+                self.database["stores"].find_one_and_update(
+                    {"id": product_raw["store_id"]},
+                    {"$inc": {"points": store_points}},
+                    return_document=pymongo.ReturnDocument.AFTER,
+                    session=session
+                )
+            ]
+            if session == None:
+                # without a transaction the updates are independent and can be in flight together
+                user_raw, store_raw = await asyncio.gather(*updates)
+            else:
+                user_raw, store_raw = [await update for update in updates]
+            if user_raw == None or store_raw == None:
+                undo = [(self.database["products"], {"id": product_id}, {"$inc": {"quantity": quantity}})]
+                if user_raw != None:
+                    undo.append((self.database["users"], {"username": username}, {"$inc": {"points": -user_points}}))
+                if store_raw != None:
+                    undo.append((self.database["stores"], {"id": product_raw["store_id"]},
+                                 {"$inc": {"points": -store_points}}))
+                await abort_purchase(session, undo, "user_not_existing" if user_raw == None else "store_not_existing")
+            if product_raw["quantity"] == 0:
+                await self.database["products"].delete_one({"id": product_id, "quantity": 0}, session=session)
+            return {
+                "store_id" : product_raw["store_id"],
+                "store_points" : store_raw["points"],
+                "user_points" : user_raw["points"]
+            }
+
+        try:
+            if self.supports_transactions():
+                async with self.client.start_session() as session:
+                    result = await session.with_transaction(apply)
+            else:
+                result = await apply(None)
+        except PurchaseAborted as e:
+            self.invalidate("products", product_id)
+            return {"error" : e.error}
+        if "error" not in result:
+            self.invalidate("products", product_id)
+            self.invalidate("users", username)
+            self.invalidate("stores", result["store_id"])
+            await self.products_changed([product_id])
+            await self.bump_version("stores")
+        return result
@@ -0,0 +1,97 @@
+import csv
+import io
+import json
+
+from classes.product import Product
+from classes.store import Store
+
+# field -> converter, every field of /add-product except store_id which is given once for the whole flyer
+PRODUCT_FIELDS = {
+    "name" : str,
+    "series" : str,
+    "price_original" : float,
+    "price_users" : float,
+    "exp_date" : str,
+    "EAN" : str,
+    "category" : str,
+    "quantity" : int,
+}
+CHUNK_SIZE = 500
+
+
+def read_ndjson(stream):
+    # yields (row number, dict or error message), one line at a time so the body is never fully in memory
+    row = 0
+    for line in stream:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        row = row + 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield row, "invalid_json"
+            continue
+        if not isinstance(record, dict):
+            yield row, "invalid_json"
+            continue
+        yield row, record
+
+
+def read_csv(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8", newline=""))
+    row = 0
+    for record in reader:
+        row = row + 1
+        yield row, record
+
+
+def validate_row(record : dict) -> dict:
+    cleaned = {}
+    for field, convert in PRODUCT_FIELDS.items():
+        value = record.get(field)
+        if value == None or value == "":
+            raise ValueError(f"missing_{field}")
+        try:
+            cleaned[field] = convert(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid_{field}")
+    if cleaned["quantity"] <= 0:
+        raise ValueError("invalid_quantity")
+    if cleaned["price_original"] <= 0 or cleaned["price_users"] < 0:
+        raise ValueError("invalid_price")
+    photo_url = record.get("photo_url")
+    cleaned["photo_url"] = "None" if photo_url == None or photo_url == "" else photo_url
+    return cleaned
+
+
+def import_products(database, store : Store, rows, chunk_size = CHUNK_SIZE):
+    # rows are validated as they arrive and written chunk by chunk, results keep the row order
+    results = []
+    pending = []
+
+    def flush():
+        errors = database.bulk_upsert_products([product for _, product in pending])
+        for position, (row, product) in enumerate(pending):
+            if position in errors:
+                results.append({"row" : row, "error" : errors[position]})
+            else:
+                results.append({"row" : row, "id" : product.id, "status" : "ok"})
+        pending.clear()
+
+    for row, record in rows:
+        if isinstance(record, str):
+            results.append({"row" : row, "error" : record})
+            continue
+        try:
+            cleaned = validate_row(record)
+        except ValueError as e:
+            results.append({"row" : row, "error" : str(e)})
+            continue
+        pending.append((row, Product(store = store, **cleaned)))
+        if len(pending) >= chunk_size:
+            flush()
+    if len(pending) > 0:
+        flush()
+    results.sort(key=lambda result: result["row"])
+    return results
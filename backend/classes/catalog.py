@@ -0,0 +1,179 @@
+import threading
+
+import numpy as np
+
+# product fields the catalog keeps, everything else is read from the database for the returned products
+CATALOG_FIELDS = ["id", "price_original", "price_users", "quantity", "exp_date", "store_id", "category"]
+# own writes remembered between two refreshes, past this the next refresh loads everything
+OWN_WRITES_LIMIT = 256
+
+
+def parse_date(value):
+    try:
+        return np.datetime64(value, "D")
+    except (TypeError, ValueError):
+        return np.datetime64("NaT")
+
+
+class ProductCatalog:
+    # one row per product in numpy columns, strings (categories, stores) are stored as integer codes
+    def __init__(self, capacity = 1024):
+        self.size = 0
+        self.ids = []
+        self.rows = {}
+        self.categories = []
+        self.category_codes = {}
+        self.store_ids = []
+        self.store_codes = {}
+        self.price_original = np.zeros(capacity, dtype=np.float64)
+        self.price_users = np.zeros(capacity, dtype=np.float64)
+        self.quantity = np.zeros(capacity, dtype=np.int64)
+        self.exp_date = np.full(capacity, np.datetime64("NaT"), dtype="datetime64[D]")
+        self.store = np.zeros(capacity, dtype=np.int32)
+        self.category = np.zeros(capacity, dtype=np.int32)
+        self.alive = np.zeros(capacity, dtype=bool)
+
+    @classmethod
+    def from_documents(cls, docs):
+        docs = list(docs)
+        catalog = cls(max(1024, len(docs)))
+        for doc in docs:
+            catalog.upsert(doc)
+        return catalog
+
+    def __len__(self):
+        return len(self.rows)
+
+    def code(self, value, values : list, codes : dict) -> int:
+        code = codes.get(value)
+        if code == None:
+            code = len(values)
+            values.append(value)
+            codes[value] = code
+        return code
+
+    def grow(self):
+        capacity = 2 * len(self.alive)
+        for column in ("price_original", "price_users", "quantity", "exp_date", "store", "category", "alive"):
+            old = getattr(self, column)
+            new = np.zeros(capacity, dtype=old.dtype)
+            if column == "exp_date":
+                new[:] = np.datetime64("NaT")
+            new[:len(old)] = old
+            setattr(self, column, new)
+
+    def upsert(self, doc):
+        row = self.rows.get(doc["id"])
+        if row == None:
+            if self.size == len(self.alive):
+                self.grow()
+            row = self.size
+            self.size = self.size + 1
+            self.ids.append(doc["id"])
+            self.rows[doc["id"]] = row
+        self.price_original[row] = doc["price_original"]
+        self.price_users[row] = doc["price_users"]
+        self.quantity[row] = doc["quantity"]
+        self.exp_date[row] = parse_date(doc.get("exp_date"))
+        self.store[row] = self.code(doc["store_id"], self.store_ids, self.store_codes)
+        self.category[row] = self.code(doc.get("category"), self.categories, self.category_codes)
+        self.alive[row] = True
+
+    def remove(self, product_id):
+        row = self.rows.pop(product_id, None)
+        if row != None:
+            self.alive[row] = False
+            self.ids[row] = None
+
+    def discounts(self):
+        # fraction of the original price saved, for every row at once
+        size = self.size
+        original = self.price_original[:size]
+        return np.divide(original - self.price_users[:size], original,
+                         out=np.zeros(size, dtype=np.float64), where=original > 0)
+
+    def mask(self, category = None, store_id = None, expires_after = None, expires_before = None):
+        size = self.size
+        mask = self.alive[:size] & (self.quantity[:size] > 0)
+        if category != None:
+            code = self.category_codes.get(category)
+            if code == None:
+                return np.zeros(size, dtype=bool)
+            mask &= self.category[:size] == code
+        if store_id != None:
+            code = self.store_codes.get(store_id)
+            if code == None:
+                return np.zeros(size, dtype=bool)
+            mask &= self.store[:size] == code
+        # comparisons with NaT are False, products without a valid date drop out of date filters
+        if expires_after != None:
+            mask &= self.exp_date[:size] >= parse_date(expires_after)
+        if expires_before != None:
+            mask &= self.exp_date[:size] <= parse_date(expires_before)
+        return mask
+
+    def best_deals(self, k : int, **filters):
+        # [(product id, discount)] of the k biggest discounts, biggest first, ties by id
+        candidates = np.flatnonzero(self.mask(**filters))
+        if len(candidates) == 0 or k <= 0:
+            return []
+        scores = self.discounts()[candidates]
+        if k < len(candidates):
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = sorted(range(len(candidates)), key=lambda i: (-scores[i], self.ids[candidates[i]]))
+        return [(self.ids[candidates[i]], float(scores[i])) for i in order]
+
+
+class LiveCatalog:
+    # ProductCatalog kept in step with the products collection, see refresh()
+    def __init__(self, database):
+        self.database = database
+        self.lock = threading.Lock()
+        self.catalog = None
+        self.version = None
+        # version produced by each of this worker's writes -> ids written (None: unknown)
+        self.own_writes = {}
+        self.reload_needed = False
+
+    def products_changed(self, ids, version):
+        # called by DatabaseInterface after it wrote products and bumped their version
+        with self.lock:
+            if self.reload_needed:
+                return
+            if len(self.own_writes) >= OWN_WRITES_LIMIT:
+                self.own_writes = {}
+                self.reload_needed = True
+                return
+            self.own_writes[version] = ids
+
+    def refresh(self):
+        # every version since the last refresh came from this worker's writes: re-read the written products,
+        # any version from someone else (or unknown writes): load everything again
+        with self.lock:
+            version = self.database.get_version("products")
+            if self.catalog != None and version == self.version:
+                return self.catalog
+            missed = [] if self.catalog == None else range(self.version + 1, version + 1)
+            if self.catalog == None or self.reload_needed or version < self.version or any(self.own_writes.get(v) == None for v in missed):
+                self.catalog = ProductCatalog.from_documents(self.database.get_products_fields(CATALOG_FIELDS))
+            else:
+                dirty = set()
+                for v in missed:
+                    dirty.update(self.own_writes[v])
+                found = {doc["id"] : doc for doc in self.database.get_products_fields(CATALOG_FIELDS, list(dirty))}
+                for product_id in dirty:
+                    if product_id in found:
+                        self.catalog.upsert(found[product_id])
+                    else:
+                        self.catalog.remove(product_id)
+            self.version = version
+            # writes up to this version are in the catalog, also those whose listener call comes late
+            self.own_writes = {v : ids for v, ids in self.own_writes.items() if v > version}
+            self.reload_needed = False
+            return self.catalog
+
+    def best_deals(self, k : int, **filters):
+        catalog = self.refresh()
+        with self.lock:
+            return catalog.best_deals(k, **filters)
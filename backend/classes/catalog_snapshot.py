@@ -0,0 +1,246 @@
+import bisect
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# file layout, all little endian:
+#   header (HEADER_SIZE bytes): magic, format, version of the products collection, rows, values, value bytes
+#   fixed-width columns, rows sorted by product id, every column padded to 8 bytes
+#   value table: offsets (values + 1 int64) and the JSON encoded values, referenced by the *_value columns
+# the returned documents are built from the value table only, so they are the same JSON MongoDB returns;
+# the number columns are copies used for filtering
+MAGIC = b"GZCATSNP"
+FORMAT = 2
+HEADER = struct.Struct("<8sIIqqqq")
+HEADER_SIZE = 64
+NUMBER_COLUMNS = [
+    ("price_users", "<f8"),
+    ("store_id", "<i8"),
+    ("exp_day", "<i8"),
+]
+VALUE_COLUMNS = ["id", "name", "location", "city", "series", "price_original", "price_users", "exp_date",
+                 "EAN", "category", "store", "store_id", "quantity", "photo_url"]
+NO_DAY = np.iinfo(np.int64).min
+NO_STORE = np.iinfo(np.int64).min
+# value code of a field the document does not have
+MISSING = -1
+
+
+def padded(size : int) -> int:
+    return (size + 7) // 8 * 8
+
+
+def day_number(value) -> int:
+    try:
+        return int(np.datetime64(value, "D").astype(np.int64))
+    except (TypeError, ValueError):
+        return NO_DAY
+
+
+def number(value, default):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return default
+
+
+def write_snapshot(path : str, docs, version : int):
+    # written next to the target and renamed over it, readers see the old or the new file, never a part
+    docs = sorted(docs, key=lambda doc: doc["id"])
+    rows = len(docs)
+    values = []
+    value_codes = {}
+
+    def code(doc, name):
+        if name not in doc:
+            return MISSING
+        encoded = json.dumps(doc[name], ensure_ascii=False).encode("utf-8")
+        found = value_codes.get(encoded)
+        if found == None:
+            found = len(values)
+            values.append(encoded)
+            value_codes[encoded] = found
+        return found
+
+    numbers = {name : np.zeros(rows, dtype=dtype) for name, dtype in NUMBER_COLUMNS}
+    codes = {name : np.zeros(rows, dtype="<i4") for name in VALUE_COLUMNS}
+    for row, doc in enumerate(docs):
+        numbers["price_users"][row] = number(doc.get("price_users"), np.nan)
+        numbers["store_id"][row] = number(doc.get("store_id"), NO_STORE)
+        numbers["exp_day"][row] = day_number(doc.get("exp_date"))
+        for name in VALUE_COLUMNS:
+            codes[name][row] = code(doc, name)
+
+    offsets = np.zeros(len(values) + 1, dtype="<i8")
+    offsets[1:] = np.cumsum([len(v) for v in values], dtype=np.int64)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, 0, version, rows, len(values), int(offsets[-1])).ljust(HEADER_SIZE, b"\0"))
+        for column in [numbers[name] for name, _ in NUMBER_COLUMNS] + [codes[name] for name in VALUE_COLUMNS]:
+            data = column.tobytes()
+            f.write(data.ljust(padded(len(data)), b"\0"))
+        f.write(offsets.tobytes())
+        f.write(b"".join(values))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def read_version(path : str):
+    try:
+        with open(path, "rb") as f:
+            magic, file_format, _, version, _, _, _ = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or file_format != FORMAT:
+        return None
+    return version
+
+
+class CatalogSnapshot:
+    # read-only view of a snapshot file, the columns are numpy arrays over the shared mapping, nothing is copied
+    def __init__(self, path : str):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, file_format, _, self.version, self.rows, value_count, value_bytes = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or file_format != FORMAT:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        offset = HEADER_SIZE
+        self.columns = {}
+        for name, dtype in NUMBER_COLUMNS + [(name + "_value", "<i4") for name in VALUE_COLUMNS]:
+            self.columns[name] = np.frombuffer(self.map, dtype=dtype, count=self.rows, offset=offset)
+            offset = offset + padded(self.rows * np.dtype(dtype).itemsize)
+        self.offsets = np.frombuffer(self.map, dtype="<i8", count=value_count + 1, offset=offset)
+        self.values_start = offset + 8 * (value_count + 1)
+        self.value_codes = {}
+
+    def value(self, code : int):
+        start = self.values_start + int(self.offsets[code])
+        end = self.values_start + int(self.offsets[code + 1])
+        return json.loads(self.map[start:end])
+
+    def code_of(self, column : str, value):
+        # value -> code for the few distinct values of a column like category or city, built once per process
+        if column not in self.value_codes:
+            codes = np.unique(self.columns[column + "_value"])
+            self.value_codes[column] = {self.value(int(c)) : int(c) for c in codes if c != MISSING}
+        return self.value_codes[column].get(value)
+
+    def row_id(self, row : int):
+        return self.value(int(self.columns["id_value"][row]))
+
+    def document(self, row : int, fields = None):
+        doc = {}
+        for name in VALUE_COLUMNS:
+            if fields != None and name != "id" and name not in fields:
+                continue
+            code = int(self.columns[name + "_value"][row])
+            if code != MISSING:
+                doc[name] = self.value(code)
+        return doc
+
+    def find_products(self, limit = None, after = None, fields = None, category = None, store_id = None, city = None,
+                      min_price = None, max_price = None, expires_after = None, expires_before = None):
+        # same filters and id order as DatabaseInterface.find_products
+        mask = np.ones(self.rows, dtype=bool)
+        for column, value in (("category", category), ("city", city)):
+            if value != None:
+                code = self.code_of(column, value)
+                if code == None:
+                    return []
+                mask &= self.columns[column + "_value"] == code
+        if store_id != None:
+            mask &= self.columns["store_id"] == store_id
+        # NaN (no price) fails both comparisons, like a missing field in MongoDB
+        if min_price != None:
+            mask &= self.columns["price_users"] >= min_price
+        if max_price != None:
+            mask &= self.columns["price_users"] <= max_price
+        days = self.columns["exp_day"]
+        if expires_after != None:
+            mask &= (days != NO_DAY) & (days >= day_number(expires_after))
+        if expires_before != None:
+            mask &= (days != NO_DAY) & (days <= day_number(expires_before))
+        start = 0
+        if after != None:
+            start = bisect.bisect_right(range(self.rows), after, key=self.row_id)
+        rows = np.flatnonzero(mask[start:]) + start
+        if limit != None:
+            rows = rows[:limit]
+        return [self.document(int(row), fields) for row in rows]
+
+
+class SharedSnapshot:
+    # the snapshot file of one products collection, shared by all workers on the machine
+    def __init__(self, path : str, database, refresh_seconds = 5, max_lag_seconds = 15):
+        self.path = path
+        self.database = database
+        # rebuilt at most every refresh_seconds, served while it is at most max_lag_seconds old
+        self.refresh_seconds = refresh_seconds
+        self.max_lag_seconds = max_lag_seconds
+        self.lock = threading.Lock()
+        self.builder = None
+        self.snapshot = None
+
+    def reopen(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if self.snapshot != None and (stat.st_ino, stat.st_mtime_ns) == (self.snapshot.stat.st_ino, self.snapshot.stat.st_mtime_ns):
+            return
+        try:
+            self.snapshot = CatalogSnapshot(self.path)
+        except (OSError, ValueError) as e:
+            logger.warning("Cannot open catalog snapshot %s: %s", self.path, e)
+
+    def current(self):
+        # the snapshot to answer from, None when the caller should ask MongoDB
+        with self.lock:
+            self.reopen()
+            snapshot = self.snapshot
+        version = self.database.get_version("products")
+        if snapshot != None and snapshot.version == version:
+            return snapshot
+        age = None if snapshot == None else time.time() - snapshot.stat.st_mtime
+        # behind the database: rebuilt in the background, requests never wait for it
+        if age == None or age >= self.refresh_seconds:
+            self.rebuild(version)
+        if age != None and age <= self.max_lag_seconds:
+            return snapshot
+        return None
+
+    def rebuild(self, version : int):
+        with self.lock:
+            if self.builder != None and self.builder.is_alive():
+                return
+            self.builder = threading.Thread(target=self.publish, args=(version,), daemon=True)
+            self.builder.start()
+
+    def publish(self, version : int) -> bool:
+        # one builder per machine, a worker that finds the file lock taken leaves the rebuild to its owner
+        with open(self.path + ".lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                current = read_version(self.path)
+                if current != None and current >= version:
+                    return True
+                write_snapshot(self.path, self.database.get_products_fields(VALUE_COLUMNS), version)
+                return True
+            except Exception as e:
+                logger.error("Cannot write catalog snapshot %s: %s", self.path, e)
+                return False
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,13 +1,290 @@
+import logging
+import re
+import threading
+
 import pymongo
+from pymongo import UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from classes.utils import haversine_km_array
+from classes.cache import TTLCache
 
-from classes.user import User
+from classes.user import User, points_for_purchase
 from classes.store import Store
 from classes.qr_codes import QR_code
 
+logger = logging.getLogger(__name__)
+
+# collection -> list of (index keys, index options)
+INDEXES = {
+    "users" : [
+        ([("username", pymongo.ASCENDING)], {"unique" : True}),
+    ],
+    "stores" : [
+        ([("id", pymongo.ASCENDING)], {"unique" : True}),
+        ([("name", pymongo.ASCENDING)], {}),
+        ([("city", pymongo.ASCENDING)], {}),
+    ],
+    "products" : [
+        ([("id", pymongo.ASCENDING)], {"unique" : True}),
+        ([("store_id", pymongo.ASCENDING), ("id", pymongo.ASCENDING)], {}),
+        ([("city", pymongo.ASCENDING), ("id", pymongo.ASCENDING)], {}),
+        ([("city", pymongo.ASCENDING), ("category", pymongo.ASCENDING), ("id", pymongo.ASCENDING)], {}),
+        ([("store_id", pymongo.ASCENDING), ("category", pymongo.ASCENDING), ("id", pymongo.ASCENDING)], {}),
+        # equality fields, then id (the sort), then the range field
+        ([("category", pymongo.ASCENDING), ("id", pymongo.ASCENDING), ("price_users", pymongo.ASCENDING)], {}),
+        ([("category", pymongo.ASCENDING), ("id", pymongo.ASCENDING), ("exp_date", pymongo.ASCENDING)], {}),
+        ([("id", pymongo.ASCENDING), ("price_users", pymongo.ASCENDING)], {}),
+        ([("id", pymongo.ASCENDING), ("exp_date", pymongo.ASCENDING)], {}),
+        ([("geo", pymongo.GEOSPHERE)], {}),
+    ],
+    "qr_codes" : [
+        ([("code", pymongo.ASCENDING)], {"unique" : True}),
+    ],
+    "geocode_cache" : [
+        ([("key", pymongo.ASCENDING)], {"unique" : True}),
+    ],
+}
+
+# indexes created by older versions, dropped by ensure_indexes
+OBSOLETE_INDEXES = {
+    "products" : [
+        [("category", pymongo.ASCENDING), ("price_users", pymongo.ASCENDING)],
+        [("exp_date", pymongo.ASCENDING), ("id", pymongo.ASCENDING)],
+        # a prefix of (category, id, price_users), which serves the same queries
+        [("category", pymongo.ASCENDING), ("id", pymongo.ASCENDING)],
+    ],
+}
+
+def products_query(category = None, store_id = None, city = None, min_price = None,
+                   max_price = None, expires_after = None, expires_before = None):
+    query = {}
+    if category != None:
+        query["category"] = category
+    if store_id != None:
+        query["store_id"] = store_id
+    if city != None:
+        query["city"] = city
+    if min_price != None or max_price != None:
+        query["price_users"] = {}
+        if min_price != None:
+            query["price_users"]["$gte"] = min_price
+        if max_price != None:
+            query["price_users"]["$lte"] = max_price
+    if expires_after != None or expires_before != None:
+        query["exp_date"] = {}
+        if expires_after != None:
+            query["exp_date"]["$gte"] = expires_after
+        if expires_before != None:
+            query["exp_date"]["$lte"] = expires_before
+    return query
+
+
+def products_projection(fields = None):
+    if fields == None:
+        return {"_id": 0, "geo": 0}
+    projection = {"_id": 0, "id": 1}
+    projection.update({f: 1 for f in fields if f not in ("_id", "geo")})
+    return projection
+
+
+# IndexNotFound, InvalidPipelineOperator, NoQueryExecutionPlans, unrecognized pipeline stage
+GEO_NEAR_UNAVAILABLE_CODES = (27, 168, 291, 40324)
+
+
+def geo_near_unavailable(error) -> bool:
+    if isinstance(error, NotImplementedError):
+        return True
+    return isinstance(error, OperationFailure) and error.code in GEO_NEAR_UNAVAILABLE_CODES
+
+
+def products_near_pipeline(lat, lon, radius_km, limit, by_score = False, query = None):
+    pipeline = [
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [lon, lat]},
+            "distanceField": "distance",
+            "maxDistance": radius_km * 1000,
+            "spherical": True,
+            "query": query or {}
+        }},
+        {"$addFields": {
+            "distance": {"$divide": ["$distance", 1000]},
+            "discount": {"$divide": [{"$subtract": ["$price_original", "$price_users"]}, "$price_original"]}
+        }}
+    ]
+    if by_score:
+        pipeline.append({"$sort": {"discount": -1, "distance": 1}})
+    pipeline.append({"$limit": limit})
+    pipeline.append({"$project": {"_id": 0, "geo": 0}})
+    return pipeline
+
+
+def nearest_products(products, lat, lon, radius_km, limit, by_score = False):
+    # in-memory counterpart of products_near_pipeline
+    import numpy as np
+    if len(products) == 0:
+        return []
+    distances = haversine_km_array(lat, lon,
+                                   [p["location"][0] for p in products],
+                                   [p["location"][1] for p in products])
+    inside = np.flatnonzero(distances <= radius_km)
+    if by_score:
+        original = np.array([products[i]["price_original"] for i in inside], dtype=np.float64)
+        users = np.array([products[i]["price_users"] for i in inside], dtype=np.float64)
+        order = inside[np.lexsort((distances[inside], -(original - users) / original))]
+    else:
+        order = inside[np.argsort(distances[inside], kind="stable")]
+    result = []
+    for i in order[:limit]:
+        product = products[i]
+        product["distance"] = float(distances[i])
+        product["discount"] = (product["price_original"] - product["price_users"]) / product["price_original"]
+        result.append(product)
+    return result
+
+
+def username_suffix_query(base : str):
+    return {"username": {"$regex": "^" + re.escape(base) + "[0-9]+$"}}
+
+
+def next_username(base : str, taken : list[str]) -> str:
+    highest = 0
+    for username in taken:
+        highest = max(highest, int(username[len(base):]))
+    return base + str(highest + 1)
+
+
+def purchase_points(product_raw : dict, quantity : int):
+    # (points for the user, points for the store)
+    from classes.product import score_for_one
+    return (
+        points_for_purchase(product_raw["price_original"], product_raw["price_users"], quantity),
+        score_for_one(product_raw["price_original"], product_raw["price_users"]) * quantity
+    )
+
+
+# collections whose read endpoints are cached by version, every write to them bumps the version
+VERSIONED_COLLECTIONS = ("products", "stores")
+
+# documents per round trip when a whole collection is streamed to the client
+STREAM_BATCH_SIZE = 500
+
+
+def unique_indexes(indexes = INDEXES) -> dict:
+    return {name : [(keys, options) for keys, options in collection_indexes if options.get("unique", False)]
+            for name, collection_indexes in indexes.items()}
+
+
+def has_index(existing, keys, options) -> bool:
+    # existing: values of index_information()
+    for index in existing:
+        if (list(map(tuple, index["key"])) == [tuple(k) for k in keys] and
+                index.get("unique", False) == options.get("unique", False)):
+            return True
+    return False
+
+
+class StockConflict(Exception):
+    # raised inside checkout to abandon a basket when another purchase took the items first
+    pass
+
+
+class PurchaseAborted(Exception):
+    # raised inside purchase/checkout when the buyer or a store is gone, error is sent to the client
+    def __init__(self, error : str):
+        super().__init__(error)
+        self.error = error
+
+
+def abort_purchase(session, undo, error : str):
+    # a transaction is aborted by the exception, without one the writes already done are reverted by hand
+    if session == None:
+        for collection, query, update in undo:
+            collection.update_one(query, update)
+    raise PurchaseAborted(error)
+
+
+class MissingIndexes(Exception):
+    # a unique index could not be built, usually because the collection already holds duplicates
+    def __init__(self, missing):
+        super().__init__("Missing unique indexes (remove the duplicates and restart): " +
+                         ", ".join(f"{name} {keys}" for name, keys in missing))
+        self.missing = missing
+
+
+# collection -> (key field, max cached documents, seconds before a cached document expires)
+ENTITY_CACHES = {
+    "stores" : ("id", 1024, 300),
+    "users" : ("username", 4096, 30),
+    "products" : ("id", 4096, 30),
+}
+
+class CommandMetrics(monitoring.CommandListener):
+    # feeds the duration of every command sent by the client into a Metrics object
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.started_commands = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = ""
+        with self.lock:
+            self.started_commands[event.request_id] = collection
+
+    def finish(self, event, failed):
+        with self.lock:
+            collection = self.started_commands.pop(event.request_id, "")
+        self.metrics.observe_command(collection, event.command_name, event.duration_micros / 1e6, failed)
+
+    def succeeded(self, event):
+        self.finish(event, False)
+
+    def failed(self, event):
+        self.finish(event, True)
+
+
 class DatabaseInterface:
-    def __init__(self, host : str, database_name : str):
-        self.client = pymongo.MongoClient(host)
+    def __init__(self, host : str, database_name : str, cache_settings = ENTITY_CACHES, metrics = None):
+        event_listeners = [] if metrics == None else [CommandMetrics(metrics)]
+        self.client = pymongo.MongoClient(host, event_listeners=event_listeners)
         self.database = self.client[database_name]
+        self.cache_keys = {}
+        self.caches = {}
+        for collection_name, (key_field, maxsize, ttl) in cache_settings.items():
+            self.cache_keys[collection_name] = key_field
+            self.caches[collection_name] = TTLCache(maxsize, ttl)
+        # called with the changed product ids after every product write, see products_changed
+        self.product_listeners = []
+        self.geo_near_warned = False
+
+    def find_one_cached(self, collection_name : str, key):
+        cache = self.caches.get(collection_name)
+        if cache != None:
+            doc = cache.get(key)
+            if doc != None:
+                return dict(doc)
+        found = self.find(collection_name, {self.cache_keys.get(collection_name, "id") : key})
+        if len(found) == 0:
+            return None
+        if cache != None:
+            cache.set(key, found[0])
+        return dict(found[0])
+
+    def invalidate(self, collection_name : str, key = None):
+        cache = self.caches.get(collection_name)
+        if cache == None:
+            return
+        if key == None:
+            cache.clear()
+        else:
+            cache.invalidate(key)
+
+    def get_cache_stats(self):
+        return {name : cache.get_stats() for name, cache in self.caches.items()}
 
     def add(self, record : dict, collection_name : str):
         collection = self.database[collection_name]
@@ -17,25 +294,39 @@ class DatabaseInterface:
         try:
             collection = self.database[collection_name]
             results = list(collection.find(query))
-        except Exception:
+        except Exception as e:
+            # callers treat a failed lookup as "not found", at least leave a trace of it
+            logger.warning("find on %s failed: %s", collection_name, e)
             results = []
         return list(results)
     
+    def next_free_username(self, base : str) -> str:
+        # one prefix query (served by the username index) for every name taken as base + number
+        taken = self.database["users"].find(username_suffix_query(base), {"_id": 0, "username": 1})
+        return next_username(base, [found["username"] for found in taken])
+
     def add_user(self, user : User) -> User:
+        # the unique index on username decides, a taken name gets the next free numeric suffix
+        base = user.username
         user_dict = user.prepare_dict()
         done = False
         while not done:
-            if len(self.find("users", { "username" : user_dict["username"] })) == 0:
+            try:
                 self.add(user_dict, "users")
                 done = True
-            else:
-                user_dict["username"] = user_dict["username"] + "0"
+            except DuplicateKeyError:
+                user_dict.pop("_id", None)
+                user_dict["username"] = self.next_free_username(base)
         user.username = user_dict["username"]
+        self.invalidate("users", user.username)
         return user
 
     def add_store(self, store : Store):
+        # raises DuplicateKeyError when the id is taken
         store_dict = store.prepare_dict()
         self.add(store_dict, "stores")
+        self.invalidate("stores", store.id)
+        self.bump_version("stores")
 
     def get_all_users(self):
         users = self.find("users", {})
@@ -45,10 +336,9 @@ class DatabaseInterface:
             return []
     
     def get_user(self, username):
-        users_list = self.find("users", {"username" : username})
-        if len(users_list) == 0:
+        user_raw = self.find_one_cached("users", username)
+        if user_raw == None:
             return None
-        user_raw = users_list[0]
         user = User.from_database(user_raw)
         return user
     
@@ -58,9 +348,24 @@ class DatabaseInterface:
             {"username": user.username},
             {"$set": {"points": user.get_points()}}
         )
+        self.invalidate("users", user.username)
 
     def get_all_stores(self):
         return self.find("stores", {})
+
+    def fill_store_places(self):
+        # stores added before city/province were saved on the document
+        stores_raw = self.find("stores", {"city" : {"$exists" : False}})
+        if len(stores_raw) == 0:
+            return
+        for store_raw in stores_raw:
+            store = Store.from_database(store_raw)
+            self.database["stores"].update_one(
+                {"id": store.id},
+                {"$set": {"city": store.location.get_city(), "province": store.location.get_province()}}
+            )
+        self.invalidate("stores")
+        self.bump_version("stores")
     
     def update_store_points(self, store : Store):
         collection = self.database["stores"]
@@ -68,22 +373,72 @@ class DatabaseInterface:
             {"id": store.id},
             {"$set": {"points": store.get_points()}}
         )
+        self.invalidate("stores", store.id)
+        self.bump_version("stores")
+
+    def get_max_store_id(self):
+        found = list(self.database["stores"].find({}, {"id": 1}).sort("id", pymongo.DESCENDING).limit(1))
+        if len(found) == 0:
+            return None
+        return found[0]["id"]
+
+    def seed_counter(self, name : str, minimum : int):
+        self.database["counters"].update_one({"_id": name}, {"$max": {"value": minimum}}, upsert=True)
+
+    def bump_version(self, collection_name : str):
+        # shared by all workers, so a cached response from any of them is stale once this moves
+        # returns the new version, so the writer knows exactly which version its write produced
+        if collection_name not in VERSIONED_COLLECTIONS:
+            return None
+        counter = self.database["counters"].find_one_and_update(
+            {"_id": "version_" + collection_name}, {"$inc": {"value": 1}},
+            upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        return counter["value"]
+
+    def products_changed(self, ids):
+        # ids of the written products, None when the write may have touched any of them
+        version = self.bump_version("products")
+        for listener in self.product_listeners:
+            listener(ids, version)
+
+    def get_version(self, collection_name : str) -> int:
+        counter = self.database["counters"].find_one({"_id": "version_" + collection_name})
+        if counter == None:
+            return 0
+        return counter["value"]
+
+    def lease_ids(self, name : str, count : int) -> int:
+        # returns the end of the leased range, the caller owns [end - count, end)
+        counter = self.database["counters"].find_one_and_update(
+            {"_id": name},
+            {"$inc": {"value": count}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        return counter["value"]
 
     def get_store(self, id) -> Store:
-        store = Store.from_database(self.find("stores", {"id" : id})[0])
-        return store
+        store_raw = self.find_one_cached("stores", id)
+        if store_raw == None:
+            return None
+        return Store.from_database(store_raw)
     
+    def get_stores(self, ids) -> dict:
+        stores = {}
+        for store_raw in self.find("stores", {"id" : {"$in" : list(ids)}}):
+            self.caches["stores"].set(store_raw["id"], store_raw)
+            stores[store_raw["id"]] = Store.from_database(store_raw)
+        return stores
+
     def get_all_products(self):
         return self.find("products", {})
     
     def update_prod_quantity(self, product, addition = True):
         collection = self.database["products"]
         if addition:
-            from classes.product import Product
-            current_prod = Product.from_database(self.find("products", {"id": product.id})[0], self)
             collection.update_one(
-                {"id": current_prod.id},
-                {"$set": {"quantity": current_prod.quantity + product.quantity}}
+                {"id": product.id},
+                {"$inc": {"quantity": product.quantity}}
             )
         else:
             if product.quantity == 0:
@@ -93,22 +448,62 @@ class DatabaseInterface:
                         {"id": product.id},
                         {"$set": {"quantity": product.quantity}}
                     )
+        self.invalidate("products", product.id)
+        self.products_changed([product.id])
 
 
     def add_product(self, product):
-        if len(self.find("products", {"id" : product.id})) == 0:
-            product_dict = product.prepare_dict()
-            self.add(product_dict, "products")
-        else:
+        try:
+            self.add(product.prepare_dict(), "products")
+            self.invalidate("products", product.id)
+            self.products_changed([product.id])
+        except DuplicateKeyError:
             self.update_prod_quantity(product)
 
+    def bulk_upsert_products(self, products) -> dict:
+        # new products are inserted whole, known ones only get more items, like add_product
+        operations = []
+        for product in products:
+            product_dict = product.prepare_dict()
+            quantity = product_dict.pop("quantity")
+            operations.append(UpdateOne(
+                {"id": product.id},
+                {"$setOnInsert": product_dict, "$inc": {"quantity": quantity}},
+                upsert=True
+            ))
+        errors = {}
+        if len(operations) == 0:
+            return errors
+        try:
+            self.database["products"].bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                errors[error["index"]] = error.get("errmsg", "write_error")
+        for product in products:
+            self.invalidate("products", product.id)
+        self.products_changed([product.id for product in products])
+        return errors
+
     def delete(self, collection_name, query):
         collection = self.database[collection_name]
         collection.delete_many(query)
+        key_field = self.cache_keys.get(collection_name)
+        if list(query.keys()) == [key_field] and not isinstance(query[key_field], dict):
+            self.invalidate(collection_name, query[key_field])
+            changed = [query[key_field]]
+        else:
+            self.invalidate(collection_name)
+            changed = None
+        if collection_name == "products":
+            self.products_changed(changed)
+        else:
+            self.bump_version(collection_name)
 
     def add_qr_code(self, code : QR_code):
-        if len(self.find("qr_codes", {"code" : code.code})) == 0:
+        try:
             self.add(code.prepare_dict(), "qr_codes")
+        except DuplicateKeyError:
+            pass
 
     def get_user_from_qr_code(self, code_raw : str) -> User:
         if len(self.find("qr_codes", {"code" : code_raw})) != 0:
@@ -118,13 +513,300 @@ class DatabaseInterface:
         
     def get_product(self, product_id):
         from classes.product import Product
-        products_list = self.find("products", {"id" : product_id})
-        if len(products_list) == 0:
+        raw_product = self.find_one_cached("products", product_id)
+        if raw_product == None:
             return None
-        raw_product = products_list[0]
         product = Product.from_database(raw_product, self)
         return product
     
+    def ensure_indexes(self, indexes = INDEXES, obsolete = OBSOLETE_INDEXES):
+        # create_index is a no-op for an existing identical index, so this is safe on every startup
+        for collection_name, collection_indexes in obsolete.items():
+            for keys in collection_indexes:
+                try:
+                    self.database[collection_name].drop_index(keys)
+                except OperationFailure:
+                    # already dropped
+                    pass
+        failed = []
+        for collection_name, collection_indexes in indexes.items():
+            collection = self.database[collection_name]
+            for keys, options in collection_indexes:
+                try:
+                    try:
+                        collection.create_index(keys, **options)
+                    except OperationFailure as e:
+                        # 85/86: same keys with different options, e.g. an older non-unique index
+                        if e.code not in (85, 86):
+                            raise
+                        collection.drop_index(keys)
+                        collection.create_index(keys, **options)
+                except Exception as e:
+                    logger.error("Cannot create index %s on %s: %s", keys, collection_name, e)
+                    failed.append((collection_name, keys))
+        return failed
+
+    def missing_indexes(self, indexes = INDEXES):
+        missing = []
+        for collection_name, collection_indexes in indexes.items():
+            existing = list(self.database[collection_name].index_information().values())
+            for keys, options in collection_indexes:
+                if not has_index(existing, keys, options):
+                    missing.append((collection_name, keys))
+        return missing
+
+    def require_unique_indexes(self):
+        # the writes rely on DuplicateKeyError, without the unique indexes they would silently insert duplicates
+        missing = self.missing_indexes(unique_indexes())
+        if len(missing) > 0:
+            raise MissingIndexes(missing)
+
+    def fill_product_places(self):
+        # products added before the city was saved on the document, only their stores are looked at
+        collection = self.database["products"]
+        store_ids = collection.distinct("store_id", {"$or": [{"city": {"$exists": False}}, {"geo": {"$exists": False}}]})
+        if len(store_ids) == 0:
+            return
+        for store_raw in self.find("stores", {"id": {"$in": store_ids}}):
+            store = Store.from_database(store_raw)
+            collection.update_many(
+                {"store_id": store.id, "city": {"$exists": False}},
+                {"$set": {"city": store.location.get_city()}}
+            )
+            collection.update_many(
+                {"store_id": store.id, "geo": {"$exists": False}},
+                {"$set": {"geo": {"type": "Point", "coordinates": [store.location.lon, store.location.lat]}}}
+            )
+        self.invalidate("products")
+        # only city and geo were added, no listener needs to look at the products again
+        self.products_changed([])
+
+    def products_query(self, **filters):
+        return products_query(**filters)
+
+    def find_products(self, query = None, limit = None, after = None, fields = None):
+        return list(self.products_cursor(query, limit, after, fields))
+
+    def iter_products(self, query = None, limit = None, after = None, fields = None, batch_size = STREAM_BATCH_SIZE):
+        return self.products_cursor(query, limit, after, fields).batch_size(batch_size)
+
+    def products_cursor(self, query = None, limit = None, after = None, fields = None):
+        # pages are ordered by product id, "after" is the last id of the previous page
+        query = dict(query or {})
+        if after != None:
+            query["id"] = {"$gt": after}
+        collection = self.database["products"]
+        cursor = collection.find(query, products_projection(fields)).sort("id", pymongo.ASCENDING)
+        if limit != None:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def get_products_fields(self, fields, ids = None):
+        query = {} if ids == None else {"id": {"$in": ids}}
+        projection = {"_id": 0}
+        projection.update({f: 1 for f in fields})
+        return self.database["products"].find(query, projection).batch_size(STREAM_BATCH_SIZE)
+
+    def get_products_by_ids(self, ids) -> list:
+        return list(self.database["products"].find({"id": {"$in": list(ids)}}, products_projection()))
+
+    def iter_stores(self, batch_size = STREAM_BATCH_SIZE):
+        return self.database["stores"].find({}, {"_id": 0}).batch_size(batch_size)
+
+    def find_products_near(self, lat, lon, radius_km, limit, by_score = False, query = None):
+        try:
+            return self._find_products_near_indexed(lat, lon, radius_km, limit, by_score, query)
+        except (OperationFailure, NotImplementedError) as e:
+            # no 2dsphere index (or a backend without $geoNear, like mongomock), compute distances in memory;
+            # anything else (timeouts, lost connection) is not worth a full collection scan
+            if not geo_near_unavailable(e):
+                raise
+            if not self.geo_near_warned:
+                logger.warning("$geoNear unavailable, scanning products in memory: %s", e)
+                self.geo_near_warned = True
+            return self._find_products_near_in_memory(lat, lon, radius_km, limit, by_score, query)
+
+    def _find_products_near_indexed(self, lat, lon, radius_km, limit, by_score, query):
+        pipeline = products_near_pipeline(lat, lon, radius_km, limit, by_score, query)
+        return list(self.database["products"].aggregate(pipeline))
+
+    def _find_products_near_in_memory(self, lat, lon, radius_km, limit, by_score, query):
+        products = list(self.database["products"].find(query or {}, {"_id": 0, "geo": 0}))
+        return nearest_products(products, lat, lon, radius_km, limit, by_score)
+
+    def supports_transactions(self):
+        return self.client.topology_description.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+
+    def run_in_transaction(self, callback):
+        # standalone servers (like the docker-compose one) have no transactions, the callback then runs as is
+        if not self.supports_transactions():
+            return callback(None)
+        with self.client.start_session() as session:
+            return session.with_transaction(callback)
+
+    def purchase(self, code_raw : str, product_id, quantity : int):
+        code_found = self.find("qr_codes", {"code" : code_raw})
+        if len(code_found) == 0:
+            return {"error" : "user_not_existing"}
+        username = code_found[0]["user"]
+
+        def apply(session):
+            product_raw = self.database["products"].find_one_and_update(
+                {"id": product_id, "quantity": {"$gte": quantity}},
+                {"$inc": {"quantity": -quantity}},
+                return_document=pymongo.ReturnDocument.AFTER,
+                session=session
+            )
+            if product_raw == None:
+                if self.database["products"].find_one({"id": product_id}, session=session) == None:
+                    return {"error" : "product_not_existing"}
+                return {"error" : "not_enough_quantity"}
+
+            user_points, store_points = purchase_points(product_raw, quantity)
+            undo = [(self.database["products"], {"id": product_id}, {"$inc": {"quantity": quantity}})]
+            store_raw = self.database["stores"].find_one_and_update(
+                {"id": product_raw["store_id"]},
+                {"$inc": {"points": store_points}},
+                return_document=pymongo.ReturnDocument.AFTER,
+                session=session
+            )
+            if store_raw == None:
+                abort_purchase(session, undo, "store_not_existing")
+            undo.append((self.database["stores"], {"id": product_raw["store_id"]}, {"$inc": {"points": -store_points}}))
+            user_raw = self.database["users"].find_one_and_update(
+                {"username": username},
+                {"$inc": {"points": user_points}},
+                return_document=pymongo.ReturnDocument.AFTER,
+                session=session
+            )
+            if user_raw == None:
+                abort_purchase(session, undo, "user_not_existing")
+            if product_raw["quantity"] == 0:
+                self.database["products"].delete_one({"id": product_id, "quantity": 0}, session=session)
+            return {
+                "store_id" : product_raw["store_id"],
+                "store_points" : store_raw["points"],
+                "user_points" : user_raw["points"]
+            }
+
+        try:
+            result = self.run_in_transaction(apply)
+        except PurchaseAborted as e:
+            self.invalidate("products", product_id)
+            return {"error" : e.error}
+        if "error" not in result:
+            self.invalidate("products", product_id)
+            self.invalidate("users", username)
+            self.invalidate("stores", result["store_id"])
+            self.products_changed([product_id])
+            self.bump_version("stores")
+        return result
+
+    def checkout(self, code_raw : str, items : dict):
+        # items: product id -> quantity, the whole basket is bought or nothing is
+        code_found = self.find("qr_codes", {"code" : code_raw})
+        if len(code_found) == 0:
+            return {"error" : "user_not_existing"}
+        username = code_found[0]["user"]
+
+        products = self.database["products"]
+        found = {p["id"] : p for p in products.find({"id" : {"$in" : list(items.keys())}}, {"_id" : 0})}
+        for product_id, quantity in items.items():
+            if product_id not in found:
+                return {"error" : "product_not_existing", "product_id" : product_id}
+            if found[product_id]["quantity"] < quantity:
+                return {"error" : "not_enough_quantity", "product_id" : product_id}
+
+        user_points = 0
+        store_points = {}
+        for product_id, quantity in items.items():
+            product_user_points, product_store_points = purchase_points(found[product_id], quantity)
+            user_points = user_points + product_user_points
+            store_id = found[product_id]["store_id"]
+            store_points[store_id] = store_points.get(store_id, 0) + product_store_points
+
+        def decrement(product_id, quantity):
+            return {"id": product_id, "quantity": {"$gte": quantity}}, {"$inc": {"quantity": -quantity}}
+
+        def apply(session):
+            if session != None:
+                result = products.bulk_write([UpdateOne(*decrement(id, q)) for id, q in items.items()],
+                                             ordered=False, session=session)
+                if result.matched_count < len(items):
+                    raise StockConflict()
+            else:
+                # no transaction to abort, so items taken before a failed one are given back
+                taken = []
+                for product_id, quantity in items.items():
+                    if products.update_one(*decrement(product_id, quantity)).matched_count == 0:
+                        if len(taken) > 0:
+                            products.bulk_write([UpdateOne({"id": id}, {"$inc": {"quantity": q}}) for id, q in taken],
+                                                ordered=False)
+                        raise StockConflict()
+                    taken.append((product_id, quantity))
+
+            undo = [(products, {"id": id}, {"$inc": {"quantity": q}}) for id, q in items.items()]
+            user_raw = self.database["users"].find_one_and_update(
+                {"username": username},
+                {"$inc": {"points": user_points}},
+                return_document=pymongo.ReturnDocument.AFTER,
+                session=session
+            )
+            if user_raw == None:
+                abort_purchase(session, undo, "user_not_existing")
+            undo.append((self.database["users"], {"username": username}, {"$inc": {"points": -user_points}}))
+            stores = []
+            for store_id, points in store_points.items():
+                store_raw = self.database["stores"].find_one_and_update(
+                    {"id": store_id},
+                    {"$inc": {"points": points}},
+                    return_document=pymongo.ReturnDocument.AFTER,
+                    session=session
+                )
+                if store_raw == None:
+                    abort_purchase(session, undo, "store_not_existing")
+                undo.append((self.database["stores"], {"id": store_id}, {"$inc": {"points": -points}}))
+                stores.append({"store_id" : store_id, "store_points" : store_raw["points"]})
+            products.delete_many({"id": {"$in": list(items.keys())}, "quantity": 0}, session=session)
+            return {
+                "stores" : stores,
+                "user_points" : user_raw["points"]
+            }
+
+        try:
+            result = self.run_in_transaction(apply)
+        except StockConflict:
+            return {"error" : "not_enough_quantity"}
+        except PurchaseAborted as e:
+            return {"error" : e.error}
+        finally:
+            for product_id in items:
+                self.invalidate("products", product_id)
+        self.invalidate("users", username)
+        for store in result["stores"]:
+            self.invalidate("stores", store["store_id"])
+        self.products_changed(list(items.keys()))
+        self.bump_version("stores")
+        return result
+
+    def get_cached_place(self, key):
+        found = self.find("geocode_cache", {"key" : key})
+        if len(found) == 0:
+            return None
+        return {"city" : found[0]["city"], "province" : found[0]["province"]}
+
+    def cache_place(self, key, place):
+        collection = self.database["geocode_cache"]
+        try:
+            collection.update_one(
+                {"key": key},
+                {"$set": {"city": place["city"], "province": place["province"]}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # another process inserted the same key between our match and insert
+            pass
+
     def get_products_dicts(self):
         def delete_id(element):
             element.pop("_id")
@@ -0,0 +1,203 @@
+import csv
+import math
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from classes.utils import haversine_km
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(__file__), "data", "pl_localities.csv")
+UNKNOWN = "Unknown"
+
+# Polish voivodeship names (as sent by the clients) -> names returned by Nominatim in English
+PROVINCES = {
+    "dolnośląskie" : "Lower Silesian Voivodeship",
+    "kujawsko-pomorskie" : "Kuyavian-Pomeranian Voivodeship",
+    "lubelskie" : "Lublin Voivodeship",
+    "lubuskie" : "Lubusz Voivodeship",
+    "łódzkie" : "Łódź Voivodeship",
+    "małopolskie" : "Lesser Poland Voivodeship",
+    "mazowieckie" : "Masovian Voivodeship",
+    "opolskie" : "Opole Voivodeship",
+    "podkarpackie" : "Subcarpathian Voivodeship",
+    "podlaskie" : "Podlaskie Voivodeship",
+    "pomorskie" : "Pomeranian Voivodeship",
+    "śląskie" : "Silesian Voivodeship",
+    "świętokrzyskie" : "Holy Cross Voivodeship",
+    "warmińsko-mazurskie" : "Warmian-Masurian Voivodeship",
+    "wielkopolskie" : "Greater Poland Voivodeship",
+    "zachodniopomorskie" : "West Pomeranian Voivodeship",
+}
+
+
+def _fold(text : str) -> str:
+    text = text.strip().casefold().replace("ł", "l")
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    for prefix in ("wojewodztwo ",):
+        if text.startswith(prefix):
+            text = text[len(prefix):]
+    for suffix in (" voivodeship", " province"):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+    return text
+
+_PROVINCE_ALIASES = {}
+for _polish, _english in PROVINCES.items():
+    _PROVINCE_ALIASES[_fold(_polish)] = _english
+    _PROVINCE_ALIASES[_fold(_english)] = _english
+
+def normalize_province(name):
+    if name == None:
+        return None
+    return _PROVINCE_ALIASES.get(_fold(name), name)
+
+
+class OfflineGeocoder:
+    # Nearest-locality lookup over the bundled gazetteer, bucketed into a lat/lon grid
+    def __init__(self, path = GAZETTEER_PATH, cell_size = 0.25, max_distance_km = 50):
+        self.cell_size = cell_size
+        self.max_distance_km = max_distance_km
+        self.cells = {}
+        self.size = 0
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                self.add_locality(row["name"], row["province"], float(row["lat"]), float(row["lon"]))
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def add_locality(self, name, province, lat, lon):
+        self.cells.setdefault(self._cell(lat, lon), []).append((lat, lon, name, province))
+        self.size = self.size + 1
+
+    def nearest(self, lat, lon):
+        lat = float(lat)
+        lon = float(lon)
+        if not (-90 <= lat <= 90):
+            return None
+        c_lat, c_lon = self._cell(lat, lon)
+        # the narrowest side of a cell is along the longitude, so it bounds every ring
+        cell_km = self.cell_size * 111.32 * max(math.cos(math.radians(min(abs(lat) + self.cell_size, 90))), 0.01)
+        max_ring = math.ceil(self.max_distance_km / cell_km) + 1
+
+        best = None
+        best_distance = self.max_distance_km
+        for ring in range(max_ring + 1):
+            if best != None and best_distance <= (ring - 1) * cell_km:
+                break
+            for d_lat in range(-ring, ring + 1):
+                for d_lon in range(-ring, ring + 1):
+                    if max(abs(d_lat), abs(d_lon)) != ring:
+                        continue
+                    for locality in self.cells.get((c_lat + d_lat, c_lon + d_lon), ()):
+                        distance = haversine_km(lat, lon, locality[0], locality[1])
+                        if distance <= best_distance:
+                            best = locality
+                            best_distance = distance
+        return best
+
+    def reverse(self, lat, lon):
+        locality = self.nearest(lat, lon)
+        if locality == None:
+            return {"city" : UNKNOWN, "province" : UNKNOWN}
+        return {"city" : locality[2], "province" : locality[3]}
+
+
+class NominatimGeocoder:
+    def __init__(self, user_agent = "geoapi"):
+        from geopy.geocoders import Nominatim
+        self.geointerpreter = Nominatim(user_agent=user_agent)
+
+    def reverse(self, lat, lon):
+        try:
+            location = self.geointerpreter.reverse((lat, lon), language="en")
+            address = location.raw.get("address", {})
+        except Exception:
+            address = {}
+        return {
+            "city" : (address.get("city") or
+                      address.get("town") or
+                      address.get("village") or
+                      address.get("hamlet") or
+                      UNKNOWN),
+            "province" : address.get("state") or address.get("region") or UNKNOWN
+        }
+
+
+class GeocodeCache:
+    # LRU in front of another geocoder, optionally persisted to a Mongo collection shared by all workers
+    def __init__(self, geocoder, database = None, maxsize = 4096, precision = 4):
+        self.geocoder = geocoder
+        self.database = database
+        self.maxsize = maxsize
+        self.precision = precision
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, lat, lon):
+        return f"{round(float(lat), self.precision)},{round(float(lon), self.precision)}"
+
+    def _remember(self, key, place):
+        with self.lock:
+            self.entries[key] = place
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def reverse(self, lat, lon):
+        key = self.key(lat, lon)
+        with self.lock:
+            place = self.entries.get(key)
+            if place != None:
+                self.entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return dict(place)
+            self.misses = self.misses + 1
+
+        if self.database != None:
+            place = self.database.get_cached_place(key)
+            if place != None:
+                self._remember(key, place)
+                return dict(place)
+
+        place = self.geocoder.reverse(lat, lon)
+        self._remember(key, place)
+        if self.database != None:
+            self.database.cache_place(key, place)
+        return dict(place)
+
+    def get_stats(self):
+        return {"size" : len(self.entries), "hits" : self.hits, "misses" : self.misses}
+
+
+def make_geocoder(name : str):
+    # "offline" reads the bundled gazetteer, "nominatim" asks OpenStreetMap over the network
+    if name == "offline":
+        return OfflineGeocoder()
+    if name == "nominatim":
+        return NominatimGeocoder()
+    raise ValueError(f"unknown geocoder {name!r}, expected 'offline' or 'nominatim'")
+
+
+def cached_geocoder(geocoder, database = None):
+    # the Mongo tier only pays off in front of the network, the offline lookup is faster than a round trip
+    if not isinstance(geocoder, NominatimGeocoder):
+        database = None
+    return GeocodeCache(geocoder, database)
+
+
+_default_geocoder = None
+
+def get_default_geocoder():
+    global _default_geocoder
+    if _default_geocoder == None:
+        _default_geocoder = OfflineGeocoder()
+    return _default_geocoder
+
+def set_default_geocoder(geocoder):
+    global _default_geocoder
+    _default_geocoder = geocoder
@@ -0,0 +1,34 @@
+import threading
+
+
+class IdAllocator:
+    # hands out ids from blocks leased atomically from a counter document, so workers never collide
+    def __init__(self, name : str, block_size = 10):
+        self.name = name
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.async_lock = None
+        self.next_id = 0
+        self.block_end = 0
+
+    def allocate(self, database) -> int:
+        with self.lock:
+            if self.next_id >= self.block_end:
+                self.block_end = database.lease_ids(self.name, self.block_size)
+                self.next_id = self.block_end - self.block_size
+            id = self.next_id
+            self.next_id = self.next_id + 1
+            return id
+
+    async def allocate_async(self, database) -> int:
+        # same as allocate, for AsyncDatabaseInterface where lease_ids is a coroutine
+        if self.async_lock == None:
+            import asyncio
+            self.async_lock = asyncio.Lock()
+        async with self.async_lock:
+            if self.next_id >= self.block_end:
+                self.block_end = await database.lease_ids(self.name, self.block_size)
+                self.next_id = self.block_end - self.block_size
+            id = self.next_id
+            self.next_id = self.next_id + 1
+            return id
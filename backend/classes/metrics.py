@@ -0,0 +1,125 @@
+import threading
+from contextvars import ContextVar
+
+# upper bounds of the histogram buckets, in seconds or in commands per request
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+# TTLCache.get_stats() keys exported per cache
+CACHE_STATS = (
+    ("hits", "gazetka_cache_hits_total", "counter", "Lookups answered from the cache."),
+    ("misses", "gazetka_cache_misses_total", "counter", "Lookups the cache could not answer."),
+    ("evictions", "gazetka_cache_evictions_total", "counter", "Entries dropped to stay within the size limit."),
+    ("size", "gazetka_cache_size", "gauge", "Entries held by the cache."),
+)
+
+# commands of the request being handled in this thread, see Metrics.begin_request
+current_request = ContextVar("current_request", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] = self.counts[i] + 1
+                break
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative = cumulative + count
+            lines.append(f"{name}_bucket{format_labels(labels + [('le', format_value(bound))])} {cumulative}")
+        lines.append(f"{name}_bucket{format_labels(labels + [('le', '+Inf')])} {self.count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(self.sum)}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+class RequestStats:
+    def __init__(self):
+        self.commands = 0
+        self.mongo_seconds = 0
+
+
+class Metrics:
+    # request and MongoDB command statistics of one process, rendered in the Prometheus text format
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.request_commands = {}
+        self.commands = {}
+        self.command_failures = {}
+
+    def begin_request(self):
+        stats = RequestStats()
+        current_request.set(stats)
+        return stats
+
+    def observe_request(self, route, method, status, seconds, stats : RequestStats = None):
+        key = (route, method, str(status))
+        with self.lock:
+            self.requests.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if stats != None:
+                self.request_commands.setdefault((route, method), Histogram(COMMAND_COUNT_BUCKETS)).observe(stats.commands)
+        current_request.set(None)
+
+    def observe_command(self, collection, command, seconds, failed = False):
+        key = (collection, command)
+        with self.lock:
+            self.commands.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if failed:
+                self.command_failures[key] = self.command_failures.get(key, 0) + 1
+        stats = current_request.get()
+        if stats != None:
+            stats.commands = stats.commands + 1
+            stats.mongo_seconds = stats.mongo_seconds + seconds
+
+    def render(self, caches = None) -> str:
+        # caches: name -> TTLCache.get_stats(), read by the caller since the caches keep their own counters
+        lines = []
+        with self.lock:
+            lines.append("# HELP gazetka_request_duration_seconds Time spent handling HTTP requests.")
+            lines.append("# TYPE gazetka_request_duration_seconds histogram")
+            for (route, method, status), histogram in sorted(self.requests.items()):
+                lines.extend(histogram.render("gazetka_request_duration_seconds",
+                                              [("route", route), ("method", method), ("status", status)]))
+            lines.append("# HELP gazetka_request_mongo_commands MongoDB commands sent while handling one request.")
+            lines.append("# TYPE gazetka_request_mongo_commands histogram")
+            for (route, method), histogram in sorted(self.request_commands.items()):
+                lines.extend(histogram.render("gazetka_request_mongo_commands", [("route", route), ("method", method)]))
+            lines.append("# HELP gazetka_mongo_command_duration_seconds Time of MongoDB commands.")
+            lines.append("# TYPE gazetka_mongo_command_duration_seconds histogram")
+            for (collection, command), histogram in sorted(self.commands.items()):
+                lines.extend(histogram.render("gazetka_mongo_command_duration_seconds",
+                                              [("collection", collection), ("command", command)]))
+            lines.append("# HELP gazetka_mongo_command_failures_total MongoDB commands that failed.")
+            lines.append("# TYPE gazetka_mongo_command_failures_total counter")
+            for (collection, command), count in sorted(self.command_failures.items()):
+                lines.append(f"gazetka_mongo_command_failures_total"
+                             f"{format_labels([('collection', collection), ('command', command)])} {count}")
+        for key, metric, kind, help_text in CACHE_STATS:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, stats in sorted((caches or {}).items()):
+                lines.append(f"{metric}{format_labels([('cache', name)])} {stats[key]}")
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value) -> str:
+    return repr(float(value))
+
+
+def format_labels(labels) -> str:
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
@@ -1,7 +1,15 @@
+from typing import TYPE_CHECKING
+
 from classes.store import Store
-from classes.database_interface import DatabaseInterface
+
+if TYPE_CHECKING:
+    from classes.database_interface import DatabaseInterface
 
 class Product:
+    # products are the most numerous objects in memory, slots keep each one small
+    __slots__ = ("name", "series", "price_original", "price_users", "exp_date", "EAN", "category",
+                 "store", "quantity", "photo_url", "id")
+
     def __init__(self, name, series, price_original, price_users, exp_date, EAN, category, store : Store, quantity, photo_url, id=None):
         self.name = name
         self.series = series
@@ -16,8 +24,9 @@ class Product:
         self.id = f"{self.store.id}_{self.EAN}_{self.series}_{round(100*float(self.price_users))}" if id==None else id
 
     @classmethod
-    def from_database(cls, doc, database : DatabaseInterface):
-        store = database.get_store(doc["store_id"])
+    def from_database(cls, doc, database : "DatabaseInterface", store : Store = None):
+        if store == None:
+            store = database.get_store(doc["store_id"])
         return cls(
             name = doc["name"],
             series = doc["series"],
@@ -28,7 +37,8 @@ class Product:
             category = doc["category"],
             store = store,
             quantity = doc["quantity"],
-            photo_url = doc["photo_url"]
+            photo_url = doc["photo_url"],
+            id = doc.get("id")
         )
 
     def get_location_coords(self):
@@ -37,11 +47,17 @@ class Product:
     def get_city(self):
         return self.store.get_location().get_city()
     
+    def get_geojson(self):
+        lat, lon = self.get_location_coords()
+        return {"type" : "Point", "coordinates" : [lon, lat]}
+    
     def prepare_dict(self):
         return dict({
             "id" : self.id,
             "name" : self.name,
             "location" : self.get_location_coords(),
+            "geo" : self.get_geojson(),
+            "city" : self.get_city(),
             "series": self.series,
             "price_original": self.price_original,
             "price_users": self.price_users,
@@ -55,15 +71,24 @@ class Product:
         })
     
     def calculate_score_for_one(self):
-        return round(((self.price_original - self.price_users)/self.price_original)*10)
+        return score_for_one(self.price_original, self.price_users)
     
     def update_quantity(self, difference : int):
         self.quantity = self.quantity + difference
     
 
-def get_all_products(database : DatabaseInterface):
+def score_for_one(price_original, price_users):
+    return round(((price_original - price_users)/price_original)*10)
+
+
+def get_all_products(database : "DatabaseInterface"):
+    # one query for the products and one for all their stores, each store shared by its products
     product_records = database.get_all_products()
+    stores = database.get_stores({rec["store_id"] for rec in product_records})
     product_objects = []
     for rec in product_records:
-        product_objects.append(Product.from_database(rec, database))
+        store = stores.get(rec["store_id"])
+        if store == None:
+            continue
+        product_objects.append(Product.from_database(rec, database, store))
     return product_objects
@@ -0,0 +1,100 @@
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+
+class RequestProfiler:
+    # profiles chosen requests with cProfile and keeps the newest max_files results in directory
+    def __init__(self, directory : str, sample_rate = 0.0, token = None, max_files = 50):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.max_files = max_files
+        # one request at a time, a second active profiler is an error on newer Pythons
+        self.active = threading.Lock()
+        self.files_lock = threading.Lock()
+
+    def authorized(self, header_value) -> bool:
+        # GAZETKA_PROFILE_TOKEN=1234 is JSON-decoded to an int, headers are always strings
+        if self.token == None or header_value == None:
+            return False
+        return hmac.compare_digest(header_value.encode(), str(self.token).encode())
+
+    def wanted(self, header_value) -> bool:
+        if self.authorized(header_value):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def begin(self, header_value = None):
+        if not self.wanted(header_value) or not self.active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile, name : str):
+        profile.disable()
+        self.active.release()
+        with self.files_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(os.path.join(self.directory, name))
+            for old in self.list_files()[self.max_files:]:
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except OSError:
+                    pass
+
+    def list_files(self):
+        # newest first, the names start with the time they were written
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted([f for f in os.listdir(self.directory) if f.endswith(".prof")], reverse=True)
+
+    def recent(self, limit = 20):
+        profiles = []
+        for name in self.list_files()[:limit]:
+            created, route, request_id = parse_profile_name(name)
+            profiles.append({
+                "name" : name,
+                "created" : created,
+                "route" : route,
+                "request_id" : request_id,
+                "size" : os.path.getsize(os.path.join(self.directory, name))
+            })
+        return profiles
+
+    def summary(self, name : str, top = 25):
+        # the most expensive functions of one profile by cumulative time, None if there is no such file
+        if name not in self.list_files():
+            return None
+        stats = pstats.Stats(os.path.join(self.directory, name))
+        functions = []
+        for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            functions.append({
+                "function" : f"{filename}:{line}({function})",
+                "calls" : calls,
+                "own_seconds" : round(own, 6),
+                "cumulative_seconds" : round(cumulative, 6)
+            })
+        functions.sort(key=lambda f: f["cumulative_seconds"], reverse=True)
+        return {"name" : name, "total_seconds" : round(stats.total_tt, 6), "functions" : functions[:top]}
+
+
+def profile_name(route : str, request_id : str) -> str:
+    # <UTC time with microseconds>_<route with "/" as "_">_<request id>.prof
+    now = time.time()
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + f"{int(now * 1e6) % 1000000:06d}"
+    route = re.sub(r"[^A-Za-z0-9-]+", "_", route).strip("_") or "root"
+    request_id = re.sub(r"[^A-Za-z0-9-]+", "", request_id)
+    return f"{stamp}_{route}_{request_id}.prof"
+
+
+def parse_profile_name(name : str):
+    stamp, rest = name[:-len(".prof")].split("_", 1)
+    route, request_id = rest.rsplit("_", 1)
+    return stamp, route, request_id
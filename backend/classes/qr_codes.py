@@ -1,6 +1,8 @@
 from datetime import datetime
 
 class QR_code:
+    __slots__ = ("user", "date", "code")
+
     def __init__(self, user, date = None, code = None):
         self.user = user
         self.date = datetime.now() if date == None else date
@@ -1,6 +1,12 @@
-from classes.utils import Location, merge_sort_ranking
+from classes.utils import Location, intern_location
+from classes.geocoding import normalize_province
+
+from sortedcontainers import SortedList
+import threading
 
 class Store:
+    __slots__ = ("id", "name", "location", "points", "password")
+
     def __init__(self, id, name : str, location : Location, password, points = 0):
         self.id = id
         self.name = name
@@ -13,7 +19,8 @@ class Store:
         return cls(
             id = doc["id"],
             name = doc["name"],
-            location = Location(doc["location"][0], doc["location"][1]),
+            location = intern_location(doc["location"][0], doc["location"][1],
+                                       city=doc.get("city"), province=doc.get("province")),
             password = doc["password"],
             points = doc["points"]
         )
@@ -24,6 +31,7 @@ class Store:
             "name" : self.name,
             "location" : self.location.get_coords(),
             "city" : self.location.get_city(),
+            "province" : self.location.get_province(),
             "points" : self.points,
             "password" : self.password
         })
@@ -39,40 +47,140 @@ class Store:
     
 
 class StoresRanking:
+    # kept ordered by (-points, id), so point updates, rank lookups and pages are O(log n)
     def __init__(self, stores : list[Store], province = "global"):
-        if province == "global":
-            self.stores = stores
-        else:
-            self.users = []
-            for u in stores:
-                if u.get_location().get_province() == province:
-                    self.stores.append(u)
-        self.current_ranking = None
-        self.update_ranking()
-
-    def update_ranking(self):
-        self.current_ranking = merge_sort_ranking(self.stores)
-    
-    def get_ranking_list(self):
-        i = 1
-        result = []
-        for record in self.current_ranking:
-            result.append({
-                "place" : i, 
-                "name" : record.name,
-                "points" : record.get_points(),
-                "coords" : record.get_location().get_coords(),
-                "store_id" : record.id
-            })
-            i = i + 1
-        return result
-    
-    def add_store(self, store):
-        self.stores.append(store)
-    
+        self.province = province if province == "global" else normalize_province(province)
+        self.stores = {}
+        self.entries = {}
+        self.ranking = SortedList()
+        for s in stores:
+            if self.province == "global" or normalize_province(s.get_location().get_province()) == self.province:
+                self.add_store(s)
+
+    def add_store(self, store : Store):
+        self.remove_store(store.id)
+        entry = (-store.get_points(), store.id)
+        self.stores[store.id] = store
+        self.entries[store.id] = entry
+        self.ranking.add(entry)
+
     def add_to_end(self, record : Store):
-        self.current_ranking.append(record)
+        self.add_store(record)
+
+    def remove_store(self, store_id):
+        self.stores.pop(store_id, None)
+        entry = self.entries.pop(store_id, None)
+        if entry != None:
+            self.ranking.remove(entry)
+
+    def set_points(self, store_id, points : int):
+        # the Store object may be shared with other rankings, so the old entry is looked up, not recomputed
+        store = self.stores.get(store_id)
+        if store == None:
+            return None
+        self.ranking.remove(self.entries[store_id])
+        store.points = points
+        self.entries[store_id] = (-points, store_id)
+        self.ranking.add(self.entries[store_id])
+        return store
+
+    def update_points(self, store_id, delta : int):
+        store = self.stores.get(store_id)
+        if store == None:
+            return None
+        return self.set_points(store_id, store.get_points() + delta)
+
+    def get_rank(self, store_id):
+        store = self.stores.get(store_id)
+        if store == None:
+            return None
+        return self.ranking.index(self.entries[store_id]) + 1
+
+    def __len__(self):
+        return len(self.ranking)
+    
+    def iter_ranking(self, offset = 0, limit = None):
+        # the page is picked at once, the records are built only when the caller consumes them
+        offset = max(0, offset)
+        stop = None if limit == None else offset + max(0, limit)
+        page = [self.stores[entry[1]] for entry in self.ranking.islice(offset, stop)]
+        return (ranking_record(place, record) for place, record in enumerate(page, offset + 1))
+
+    def get_ranking_list(self, offset = 0, limit = None):
+        return list(self.iter_ranking(offset, limit))
     
+
+class StoresRankings:
+    # global ranking plus one ranking per province, all sharing the same Store objects
+    def __init__(self, stores : list[Store], version = 0):
+        self.lock = threading.RLock()
+        # changes with every modification, so responses built from the rankings can be cached
+        self.version = version
+        self.global_ranking = StoresRanking([])
+        self.provinces = {}
+        for s in stores:
+            self.add_store(s)
+
+    def add_store(self, store : Store):
+        province = normalize_province(store.get_location().get_province())
+        with self.lock:
+            if province not in self.provinces:
+                self.provinces[province] = StoresRanking([], province)
+            self.global_ranking.add_store(store)
+            self.provinces[province].add_store(store)
+            self.version = self.version + 1
+
+    def get(self, province = None) -> StoresRanking:
+        if province == None or province == "global":
+            return self.global_ranking
+        province = normalize_province(province)
+        if province not in self.provinces:
+            return StoresRanking([], province)
+        return self.provinces[province]
+
+    def get_store(self, store_id) -> Store:
+        return self.global_ranking.stores.get(store_id)
+
+    def set_points(self, store_id, points : int):
+        with self.lock:
+            store = self.global_ranking.stores.get(store_id)
+            if store == None:
+                return None
+            self.global_ranking.set_points(store_id, points)
+            self.provinces[normalize_province(store.get_location().get_province())].set_points(store_id, points)
+            self.version = self.version + 1
+            return store
+
+    def update_points(self, store_id, delta : int):
+        with self.lock:
+            store = self.global_ranking.stores.get(store_id)
+            if store == None:
+                return None
+            return self.set_points(store_id, store.get_points() + delta)
+
+    def get_rank(self, store_id, province = None):
+        with self.lock:
+            return self.get(province).get_rank(store_id)
+
+    def get_ranking_list(self, province = None, offset = 0, limit = None):
+        with self.lock:
+            return self.get(province).get_ranking_list(offset, limit)
+
+    def iter_ranking(self, province = None, offset = 0, limit = None):
+        with self.lock:
+            return self.get(province).iter_ranking(offset, limit)
+
+
+def ranking_record(place : int, record : Store):
+    return {
+        "place" : place,
+        "name" : record.name,
+        "points" : record.get_points(),
+        "coords" : record.get_location().get_coords(),
+        "store_id" : record.id
+    }
+
+
 def get_all_stores(database):
     stores_records = database.get_all_stores()
     stores_objects = []
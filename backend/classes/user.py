@@ -3,6 +3,8 @@ from classes.utils import Location, merge_sort_ranking
 from datetime import datetime
 
 class User:
+    __slots__ = ("username", "email", "password", "points")
+
     def __init__(self, username : str, email : str, password : str, points = 0):
         self.username = username
         self.email = email
@@ -22,9 +24,7 @@ class User:
         return f"{self.username}_{datetime.now().strftime('%Y%m%d%H%M')}"
     
     def add_points(self, product, quantity):
-        unit_saved_money = product.price_original - product.price_users
-        saved_money = quantity * unit_saved_money
-        points = int(saved_money * 100)
+        points = points_for_purchase(product.price_original, product.price_users, quantity)
         self.points = self.points + points
 
     def get_points(self):
@@ -45,6 +45,12 @@ class User:
         })
     
 
+def points_for_purchase(price_original, price_users, quantity):
+    unit_saved_money = price_original - price_users
+    saved_money = quantity * unit_saved_money
+    return int(saved_money * 100)
+
+
 def get_all_users(database):
     users_records = database.get_all_users()
     users_objects = []
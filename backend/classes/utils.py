@@ -1,36 +1,78 @@
-from geopy.geocoders import Nominatim
+import math
+import threading
+import weakref
+
 
 class Location:
-    def __init__(self, latitude, longitude):
+    # slots instead of a per-instance __dict__, there is one Location per store and many stores in memory
+    __slots__ = ("lat", "lon", "geocoder", "city", "province", "__weakref__")
+
+    def __init__(self, latitude, longitude, geocoder = None, city = None, province = None):
         self.lat = latitude
         self.lon = longitude
-    
+        self.geocoder = geocoder
+        self.city = city
+        self.province = province
+
+    def get_geocoder(self):
+        if self.geocoder == None:
+            from classes.geocoding import get_default_geocoder
+            return get_default_geocoder()
+        return self.geocoder
+
+    def resolve(self):
+        place = self.get_geocoder().reverse(self.lat, self.lon)
+        self.city = place["city"]
+        self.province = place["province"]
+
     def get_city(self):
-        try:
-            geointerpreter = Nominatim(user_agent="geoapi")
-            location = geointerpreter.reverse((self.lat, self.lon), language="en")
-            address = location.raw.get("address", {})
-            
-            return (address.get("city") or
-                    address.get("town") or
-                    address.get("village") or
-                    address.get("hamlet") or
-                    "Unknown")
-        except Exception:
-            return "Unknown"
+        if self.city == None:
+            self.resolve()
+        return self.city
     
     def get_province(self):
-        try:
-            geointerpreter = Nominatim(user_agent="geoapi")
-            location = geointerpreter.reverse((self.lat, self.lon), language="en")
-            address = location.raw.get("address", {})
-            
-            return address.get("state") or address.get("region") or "Unknown"
-        except Exception:
-            return "Unknown"
+        if self.province == None:
+            self.resolve()
+        return self.province
     
     def get_coords(self):
         return (self.lat, self.lon)
+
+
+# (lat, lon) -> Location still used somewhere, entries vanish with the last reference
+_locations = weakref.WeakValueDictionary()
+_locations_lock = threading.Lock()
+
+def intern_location(latitude, longitude, city = None, province = None) -> Location:
+    # the same coordinates give the same shared Location, so its city is also resolved only once
+    key = (latitude, longitude)
+    with _locations_lock:
+        location = _locations.get(key)
+        if location == None:
+            location = Location(latitude, longitude, city=city, province=province)
+            _locations[key] = location
+            return location
+    if location.city == None and city != None:
+        location.city = city
+    if location.province == None and province != None:
+        location.province = province
+    return location
+    
+
+def haversine_km(lat_1, lon_1, lat_2, lon_2):
+    lat_1, lon_1, lat_2, lon_2 = map(math.radians, (lat_1, lon_1, lat_2, lon_2))
+    a = (math.sin((lat_2 - lat_1) / 2) ** 2 +
+         math.cos(lat_1) * math.cos(lat_2) * math.sin((lon_2 - lon_1) / 2) ** 2)
+    return 2 * 6371.0088 * math.asin(math.sqrt(a))
+
+def haversine_km_array(lat, lon, lats, lons):
+    # numpy is imported on first use, it is the slowest part of importing the server
+    import numpy as np
+    lat, lon = math.radians(lat), math.radians(lon)
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    a = np.sin((lats - lat) / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * 6371.0088 * np.arcsin(np.sqrt(a))
     
 
 def merge_sort_ranking(arr):
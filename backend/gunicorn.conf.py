@@ -0,0 +1,10 @@
+import os
+
+# production serving: pre-forked workers, each with its own Mongo client and AppState
+bind = "0.0.0.0:" + os.environ.get("PORT", "6969")
+workers = int(os.environ.get("GUNICORN_WORKERS", (os.cpu_count() or 1) * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+# pymongo clients must not be shared across fork, so the app is created in every worker
+preload_app = False
@@ -0,0 +1,105 @@
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes.product import Product
+from classes.store import Store
+
+# usage: python testing/bench_domain_objects.py [--products 100000] [--stores 200]
+# memory is what tracemalloc sees allocated by the hydrated objects, the source documents are not counted
+
+
+def make_documents(products, stores, seed):
+    rng = random.Random(seed)
+    store_docs = [{
+        "id" : i,
+        "name" : f"store_{i}",
+        "location" : [round(rng.uniform(49.1, 54.7), 4), round(rng.uniform(14.2, 24.0), 4)],
+        "city" : "Warsaw",
+        "province" : "Masovian Voivodeship",
+        "password" : "p",
+        "points" : rng.randint(0, 1000)
+    } for i in range(stores)]
+    product_docs = []
+    for i in range(products):
+        price_original = round(rng.uniform(2, 50), 2)
+        store_id = rng.randrange(stores)
+        product_docs.append({
+            "id" : f"{store_id}_{5900000000000 + i}_S_{i}",
+            "name" : f"product_{i}",
+            "series" : "S",
+            "price_original" : price_original,
+            "price_users" : round(price_original * 0.8, 2),
+            "exp_date" : "2030-01-01",
+            "EAN" : str(5900000000000 + i),
+            "category" : rng.choice(["Nabiał", "Pieczywo", "Napoje"]),
+            "store_id" : store_id,
+            "quantity" : rng.randint(1, 100),
+            "photo_url" : "None"
+        })
+    return store_docs, product_docs
+
+
+def hydrate_shared(store_docs, product_docs):
+    # one Store per store id, as get_all_products does
+    stores = {doc["id"] : Store.from_database(doc) for doc in store_docs}
+    return [Product.from_database(doc, None, stores[doc["store_id"]]) for doc in product_docs]
+
+
+def hydrate_per_product(store_docs, product_docs):
+    # a Store built for every product, as Product.from_database without a store does
+    by_id = {doc["id"] : doc for doc in store_docs}
+    return [Product.from_database(doc, None, Store.from_database(by_id[doc["store_id"]])) for doc in product_docs]
+
+
+def measure(hydrate, store_docs, product_docs):
+    gc.collect()
+    start = time.perf_counter()
+    products = hydrate(store_docs, product_docs)
+    seconds = time.perf_counter() - start
+    del products
+
+    gc.collect()
+    tracemalloc.start()
+    products = hydrate(store_docs, product_docs)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del products
+    return {
+        "products_per_second" : round(len(product_docs) / seconds),
+        "bytes_per_product" : round(allocated / len(product_docs), 1),
+        "mb_per_100k_products" : round(allocated / len(product_docs) * 100000 / 2**20, 2)
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Memory and hydration speed of the domain objects")
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--stores", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="also save the results as JSON")
+    args = parser.parse_args(argv)
+
+    store_docs, product_docs = make_documents(args.products, args.stores, args.seed)
+    results = {
+        "products" : args.products,
+        "stores" : args.stores,
+        "shared_stores" : measure(hydrate_shared, store_docs, product_docs),
+        "store_per_product" : measure(hydrate_per_product, store_docs, product_docs)
+    }
+    print(json.dumps(results, indent=2))
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
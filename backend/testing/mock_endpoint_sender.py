@@ -1,17 +1,15 @@
 import requests
 
-def send_to_endpoint_store(url, name, location, password):
-    payload = {
+# payload builders are shared with load_test.py
+
+def store_payload(name, location, password):
+    return {
         "name": name,
         "location": location,
         "password" : password
     }
 
-    response = requests.post(url, json=payload)
-    return response
-
-def send_to_endpoint_product(
-        url,
+def product_payload(
         name,
         series,
         price_original,
@@ -23,8 +21,7 @@ def send_to_endpoint_product(
         quantity,
         photo_url="None"
     ):
-
-    payload = {
+    return {
         "name": name,
         "series": series,
         "price_original": price_original,
@@ -37,18 +34,38 @@ def send_to_endpoint_product(
         "photo_url": photo_url
     }
 
+def buy_product_payload(code, product_id, quantity, store_id):
+    return {
+        "code": code,
+        "product_id": product_id,
+        "quantity": quantity,
+        "store_id": store_id
+    }
+
+def add_user_payload(username, email, password):
+    return {
+        "username": username,
+        "password": password,
+        "email": email
+    }
+
+
+def send_to_endpoint_store(url, name, location, password):
+    payload = store_payload(name, location, password)
+
+    response = requests.post(url, json=payload)
+    return response
+
+def send_to_endpoint_product(url, *args, **kwargs):
+    payload = product_payload(*args, **kwargs)
+
     print(payload)
 
     response = requests.post(url, json=payload)
     return response
 
 def send_buy_product_request(url, code, product_id, quantity, store_id):
-    payload = {
-        "code": code,
-        "product_id": product_id,
-        "quantity": quantity,
-        "store_id": store_id
-    }
+    payload = buy_product_payload(code, product_id, quantity, store_id)
 
     print(payload)
 
@@ -56,18 +73,16 @@ def send_buy_product_request(url, code, product_id, quantity, store_id):
     return response
 
 def send_add_user_request(url, username, email, password):
-    payload = {
-        "username": username,
-        "password": password,
-        "email": email
-    }
+    payload = add_user_payload(username, email, password)
 
     print(payload)
 
     response = requests.post(url, json=payload)
     return response
 
-send_to_endpoint_store("http://localhost:6969/add-store", "melina", (51.1,21.1), "melina")
+
+if __name__ == "__main__":
+    send_to_endpoint_store("http://localhost:6969/add-store", "melina", (51.1,21.1), "melina")
 
 # resp = send_to_endpoint_product(
 #     "http://localhost:6969/add-product",
@@ -0,0 +1,135 @@
+import pytest
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes.async_database_interface import AsyncDatabaseInterface
+from classes.user import User
+from pymongo.errors import DuplicateKeyError
+
+
+# -------------------------------
+# FIXTURY
+# -------------------------------
+
+def mock_collection():
+    collection = MagicMock()
+    for method in ("insert_one", "update_one", "delete_one", "delete_many", "find_one", "find_one_and_update"):
+        setattr(collection, method, AsyncMock())
+    collection.find.return_value.to_list = AsyncMock(return_value=[])
+    return collection
+
+
+@pytest.fixture
+def database():
+    # AsyncMongoClient connects lazily, so no server is needed as long as collections are mocked
+    db = AsyncDatabaseInterface("mongodb://localhost:27017/", "gazetka_test")
+    collections = {}
+    db.database = MagicMock()
+    db.database.__getitem__.side_effect = lambda name: collections.setdefault(name, mock_collection())
+    db.supports_transactions = MagicMock(return_value=False)
+    db.database["counters"].find_one_and_update.return_value = {"value" : 1}
+    db.database["qr_codes"].find.return_value.to_list.return_value = [{"code" : "c1", "user" : "jan"}]
+    return db
+
+
+@pytest.fixture
+def bought(database):
+    database.database["products"].find_one_and_update.return_value = {"id" : "p1", "store_id" : 7, "quantity" : 1,
+                                                                       "price_original" : 10, "price_users" : 5}
+    database.database["users"].find_one_and_update.return_value = {"points" : 1000}
+    database.database["stores"].find_one_and_update.return_value = {"points" : 11}
+    return database
+
+
+def version_bumps(database):
+    return [c[0][0]["_id"] for c in database.database["counters"].find_one_and_update.call_args_list]
+
+
+# -------------------------------
+# TEST: add_user
+# -------------------------------
+def test_add_user_suffixes_taken_name(database):
+    users = database.database["users"]
+    users.insert_one.side_effect = [DuplicateKeyError("dup"), None]
+    users.find.return_value.to_list.return_value = [{"username" : "jan1"}]
+
+    user = asyncio.run(database.add_user(User("jan", "jan@example.com", "p")))
+
+    assert user.username == "jan2"
+    assert users.insert_one.call_args[0][0]["username"] == "jan2"
+
+
+# -------------------------------
+# TEST: versions
+# -------------------------------
+def test_writes_bump_version(database):
+    product = MagicMock()
+    product.id = "p1"
+    seen = []
+    database.product_listeners.append(lambda ids, version: seen.append((ids, version)))
+
+    asyncio.run(database.add_product(product))
+    asyncio.run(database.delete("stores", {"id" : 3}))
+    asyncio.run(database.delete("qr_codes", {"code" : "c1"}))
+
+    assert version_bumps(database) == ["version_products", "version_stores"]
+    assert seen == [(["p1"], 1)]
+
+
+# -------------------------------
+# TEST: purchase
+# -------------------------------
+def test_purchase_without_transaction(bought):
+    result = asyncio.run(bought.purchase("c1", "p1", 2))
+
+    assert result == {"store_id" : 7, "store_points" : 11, "user_points" : 1000}
+    assert bought.database["users"].find_one_and_update.call_args[0][1] == {"$inc" : {"points" : 1000}}
+    assert bought.database["stores"].find_one_and_update.call_args[0][1] == {"$inc" : {"points" : 10}}
+    bought.database["products"].delete_one.assert_not_awaited()
+    assert version_bumps(bought) == ["version_products", "version_stores"]
+
+
+def test_purchase_in_transaction_deletes_sold_out(bought):
+    bought.supports_transactions.return_value = True
+    bought.database["products"].find_one_and_update.return_value["quantity"] = 0
+    session = MagicMock()
+
+    async def with_transaction(callback):
+        return await callback(session)
+    session.with_transaction = with_transaction
+    bought.client = MagicMock()
+    bought.client.start_session.return_value.__aenter__ = AsyncMock(return_value=session)
+    bought.client.start_session.return_value.__aexit__ = AsyncMock(return_value=False)
+
+    result = asyncio.run(bought.purchase("c1", "p1", 2))
+
+    assert result["user_points"] == 1000
+    assert bought.database["users"].find_one_and_update.call_args[1]["session"] == session
+    bought.database["products"].delete_one.assert_awaited_once_with({"id" : "p1", "quantity" : 0}, session=session)
+
+
+def test_purchase_not_enough_quantity(bought):
+    bought.database["products"].find_one_and_update.return_value = None
+    bought.database["products"].find_one.return_value = {"id" : "p1", "quantity" : 1}
+
+    assert asyncio.run(bought.purchase("c1", "p1", 2)) == {"error" : "not_enough_quantity"}
+    bought.database["users"].find_one_and_update.assert_not_called()
+    assert version_bumps(bought) == []
+
+
+def test_purchase_store_gone_gives_back(bought):
+    bought.database["stores"].find_one_and_update.return_value = None
+
+    assert asyncio.run(bought.purchase("c1", "p1", 2)) == {"error" : "store_not_existing"}
+    bought.database["products"].update_one.assert_awaited_once_with({"id" : "p1"}, {"$inc" : {"quantity" : 2}})
+    bought.database["users"].update_one.assert_awaited_once_with({"username" : "jan"}, {"$inc" : {"points" : -1000}})
+    assert version_bumps(bought) == []
+
+
+def test_purchase_unknown_code(database):
+    database.database["qr_codes"].find.return_value.to_list.return_value = []
+    assert asyncio.run(database.purchase("c2", "p1", 1)) == {"error" : "user_not_existing"}
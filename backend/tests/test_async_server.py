@@ -0,0 +1,109 @@
+import pytest
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import async_server as quart_app_module
+
+
+# ---------------------------
+# MOCK DATABASE
+# ---------------------------
+@pytest.fixture
+def mock_database():
+    mock_db = AsyncMock()
+    mock_db.products_query = MagicMock(return_value={})
+    mock_db.get_all_stores.return_value = [
+        {"id": 1, "name": "A", "location": [52.2, 21.0], "password": "p", "points": 5,
+         "city": "Warsaw", "province": "Masovian Voivodeship"},
+        {"id": 2, "name": "B", "location": [50.0, 19.9], "password": "p", "points": 9,
+         "city": "Kraków", "province": "Lesser Poland Voivodeship"},
+    ]
+    mock_db.lease_ids.return_value = 10
+    mock_db.find_products.return_value = []
+    return mock_db
+
+
+def call(mock_database, method, path, **kwargs):
+    async def run():
+        app = quart_app_module.create_app({"TESTING" : True}, database=mock_database)
+        client = app.test_client()
+        response = await getattr(client, method)(path, **kwargs)
+        return response.status_code, await response.get_json()
+    return asyncio.run(run())
+
+
+# ---------------------------
+# TEST /add-store
+# ---------------------------
+def test_add_store(mock_database):
+    status, data = call(mock_database, "post", "/add-store", json={
+        "name": "Test Store",
+        "location": [52.23, 21.01],
+        "password": "secret"
+    })
+    assert status == 200
+    assert data["id"] == 0
+    assert data["city"] == "Warsaw"
+    mock_database.add_store.assert_awaited_once()
+
+
+# ---------------------------
+# TEST /stores-ranking, /store-rank
+# ---------------------------
+def test_stores_ranking(mock_database):
+    status, data = call(mock_database, "get", "/stores-ranking")
+    assert [r["store_id"] for r in data] == [2, 1]
+
+    status, data = call(mock_database, "get", "/store-rank?store_id=1&province=mazowieckie")
+    assert data["place"] == 1
+    assert data["points"] == 5
+
+
+# ---------------------------
+# TEST /products
+# ---------------------------
+def test_products_page(mock_database):
+    mock_database.find_products.return_value = [{"id": "a"}, {"id": "b"}]
+    status, data = call(mock_database, "get", "/products?limit=2&after=0")
+    assert data == [{"id": "a"}, {"id": "b"}]
+    mock_database.find_products.assert_awaited_once_with({}, 2, "0", None)
+
+
+# ---------------------------
+# TEST /buy-product
+# ---------------------------
+def test_buy_product(mock_database):
+    mock_database.purchase.return_value = {"store_id": 1, "store_points": 50, "user_points": 7}
+    status, data = call(mock_database, "post", "/buy-product", json={
+        "code": "abc", "product_id": "p1", "quantity": 2
+    })
+    assert data == {"status": "ok", "store_points": 50, "users_points": 7}
+    mock_database.purchase.assert_awaited_once_with("abc", "p1", 2)
+
+
+def test_buy_product_error(mock_database):
+    mock_database.purchase.return_value = {"error": "not_enough_quantity"}
+    status, data = call(mock_database, "post", "/buy-product", json={
+        "code": "abc", "product_id": "p1", "quantity": 2
+    })
+    assert data == {"error": "not_enough_quantity"}
+
+    status, data = call(mock_database, "post", "/buy-product", json={
+        "code": "abc", "product_id": "p1", "quantity": 0
+    })
+    assert data == {"error": "wrong_quantity"}
+
+
+# ---------------------------
+# TEST /update-product
+# ---------------------------
+def test_update_product_unknown_store(mock_database):
+    mock_database.get_store.return_value = None
+    status, data = call(mock_database, "post", "/update-product", json={"id": "p1", "name": "X", "store_id": "0"})
+    assert data == {"error": "store_not_existing"}
+    # the product is kept
+    mock_database.delete.assert_not_awaited()
+    mock_database.add_product.assert_not_awaited()
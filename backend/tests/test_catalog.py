@@ -0,0 +1,241 @@
+import json
+import pytest
+from unittest.mock import MagicMock
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes.catalog import OWN_WRITES_LIMIT, LiveCatalog, ProductCatalog
+from classes.catalog_snapshot import CatalogSnapshot, SharedSnapshot, read_version, write_snapshot
+
+
+# -------------------------------
+# FIXTURY
+# -------------------------------
+
+def product(id, price_original, price_users, quantity = 5, category = "Nabiał", store_id = 1, exp_date = "2025-06-01"):
+    return {"id" : id, "price_original" : price_original, "price_users" : price_users, "quantity" : quantity,
+            "category" : category, "store_id" : store_id, "exp_date" : exp_date}
+
+
+@pytest.fixture
+def products():
+    return [
+        product("a", 10, 9),
+        product("b", 10, 5, category="Pieczywo"),
+        product("c", 10, 2, store_id=2, exp_date="2025-01-01"),
+        product("d", 10, 3, quantity=0),
+        product("e", 10, 5, exp_date="not a date"),
+    ]
+
+
+@pytest.fixture
+def catalog(products):
+    return ProductCatalog.from_documents(products)
+
+
+# -------------------------------
+# TEST: ProductCatalog
+# -------------------------------
+def test_best_deals_order(catalog):
+    assert catalog.best_deals(10) == [("c", 0.8), ("b", 0.5), ("e", 0.5), ("a", pytest.approx(0.1))]
+    assert catalog.best_deals(2) == [("c", 0.8), ("b", 0.5)]
+
+
+def test_best_deals_filters(catalog):
+    assert [id for id, _ in catalog.best_deals(10, category="Nabiał")] == ["c", "e", "a"]
+    assert [id for id, _ in catalog.best_deals(10, store_id=2)] == ["c"]
+    assert [id for id, _ in catalog.best_deals(10, expires_after="2025-02-01")] == ["b", "a"]
+    assert catalog.best_deals(10, category="Mięso") == []
+    assert catalog.best_deals(10, store_id=99) == []
+
+
+def test_upsert_and_remove(catalog):
+    catalog.upsert(product("a", 10, 1))
+    catalog.remove("c")
+    assert catalog.best_deals(1) == [("a", 0.9)]
+    assert len(catalog) == 4
+
+
+def test_grows_past_capacity():
+    catalog = ProductCatalog(capacity=2)
+    for i in range(5):
+        catalog.upsert(product(str(i), 10, i))
+    assert [id for id, _ in catalog.best_deals(5)] == ["0", "1", "2", "3", "4"]
+    assert catalog.categories == ["Nabiał"]
+
+
+# -------------------------------
+# TEST: LiveCatalog
+# -------------------------------
+def test_live_catalog_incremental_and_reload(products):
+    database = MagicMock()
+    database.get_version.return_value = 3
+    database.get_products_fields.return_value = products
+    live = LiveCatalog(database)
+    assert live.best_deals(1) == [("c", 0.8)]
+
+    # this worker changed "a": only "a" is read again
+    live.products_changed(["a"], 4)
+    database.get_version.return_value = 4
+    database.get_products_fields.return_value = [product("a", 10, 0)]
+    assert live.best_deals(1) == [("a", 1.0)]
+    assert database.get_products_fields.call_args[0][1] == ["a"]
+
+    # another worker wrote version 5: everything is read again
+    live.products_changed(["b"], 6)
+    database.get_version.return_value = 6
+    database.get_products_fields.return_value = products
+    assert live.best_deals(1) == [("c", 0.8)]
+    assert len(database.get_products_fields.call_args[0]) == 1
+
+
+def test_live_catalog_late_listener_call(products):
+    database = MagicMock()
+    database.get_version.return_value = 1
+    database.get_products_fields.return_value = products
+    live = LiveCatalog(database)
+    live.refresh()
+
+    # own write bumped the version to 2 and a refresh loaded it before the listener was called
+    database.get_version.return_value = 2
+    live.refresh()
+    live.products_changed(["a"], 2)
+
+    # version 3 is another worker's write, it must not be mistaken for the own one
+    database.get_version.return_value = 3
+    database.get_products_fields.return_value = products + [product("q", 10, 1)]
+    assert live.best_deals(1) == [("q", 0.9)]
+    assert len(database.get_products_fields.call_args[0]) == 1
+
+
+def test_live_catalog_own_writes_are_bounded(products):
+    database = MagicMock()
+    database.get_version.return_value = 0
+    database.get_products_fields.return_value = products
+    live = LiveCatalog(database)
+    live.refresh()
+
+    # a worker that stopped serving /best-deals keeps writing
+    for version in range(1, OWN_WRITES_LIMIT + 50):
+        live.products_changed(["a"], version)
+    assert len(live.own_writes) <= OWN_WRITES_LIMIT
+
+    database.get_version.return_value = OWN_WRITES_LIMIT + 49
+    live.refresh()
+    assert len(database.get_products_fields.call_args[0]) == 1
+    assert live.own_writes == {}
+
+
+# -------------------------------
+# TEST: CatalogSnapshot
+# -------------------------------
+def full_product(id, price_users, category = "Nabiał", store_id = 1, exp_date = "2025-06-01", city = "Warszawa"):
+    doc = product(id, 10, price_users, category=category, store_id=store_id, exp_date=exp_date)
+    doc.update({"name" : f"product {id}", "series" : "S", "EAN" : 590, "photo_url" : None,
+                "store" : "Sklep", "city" : city, "location" : [52.2, 21.0]})
+    return doc
+
+
+@pytest.fixture
+def snapshot_products():
+    without_photo = full_product("d", 3.5, exp_date="not a date")
+    without_photo.pop("photo_url")
+    return [
+        full_product("c", 2, store_id=2, exp_date="2025-01-01", city="Kraków"),
+        full_product("a", 9),
+        full_product("b", 5, category="Pieczywo"),
+        without_photo,
+    ]
+
+
+def snapshot_of(tmp_path, docs, version = 1):
+    path = str(tmp_path / "catalog.snapshot")
+    write_snapshot(path, docs, version)
+    return CatalogSnapshot(path)
+
+
+def test_snapshot_round_trip(tmp_path, snapshot_products):
+    snapshot = snapshot_of(tmp_path, snapshot_products, 7)
+
+    assert snapshot.version == 7
+    assert read_version(str(tmp_path / "catalog.snapshot")) == 7
+    # the same JSON as MongoDB returns: integers stay integers, missing fields stay missing
+    expected = sorted(snapshot_products, key=lambda doc: doc["id"])
+    assert json.dumps(snapshot.find_products(), sort_keys=True) == json.dumps(expected, sort_keys=True)
+    assert snapshot.find_products(fields=["price_users"])[0] == {"id" : "a", "price_users" : 9}
+
+
+def test_snapshot_filters_and_pages(tmp_path, snapshot_products):
+    snapshot = snapshot_of(tmp_path, snapshot_products)
+
+    def ids(**kwargs):
+        return [doc["id"] for doc in snapshot.find_products(**kwargs)]
+    assert ids(category="Nabiał") == ["a", "c", "d"]
+    assert ids(category="Mięso") == []
+    assert ids(city="Kraków") == ["c"]
+    assert ids(store_id=1, max_price=5) == ["b", "d"]
+    assert ids(min_price=5) == ["a", "b"]
+    assert ids(expires_after="2025-02-01") == ["a", "b"]
+    assert ids(limit=2) == ["a", "b"]
+    assert ids(limit=2, after="b") == ["c", "d"]
+    assert ids(after="bb") == ["c", "d"]
+
+
+# -------------------------------
+# TEST: SharedSnapshot
+# -------------------------------
+@pytest.fixture
+def snapshot_database(snapshot_products):
+    database = MagicMock()
+    database.get_version.return_value = 1
+    database.get_products_fields.return_value = snapshot_products
+    return database
+
+
+def current(shared):
+    # waits for the background rebuild the call started, if any
+    snapshot = shared.current()
+    if shared.builder != None:
+        shared.builder.join()
+    return snapshot
+
+
+def test_shared_snapshot_follows_version(tmp_path, snapshot_database, snapshot_products):
+    path = str(tmp_path / "catalog.snapshot")
+    first = SharedSnapshot(path, snapshot_database, refresh_seconds=0)
+    # nothing published yet: MongoDB answers while the snapshot is built
+    assert current(first) == None
+    assert current(first).version == 1
+
+    # a second worker maps the published file instead of reading MongoDB
+    snapshot_database.get_products_fields.reset_mock()
+    second = SharedSnapshot(path, snapshot_database, refresh_seconds=0)
+    assert current(second).version == 1
+    snapshot_database.get_products_fields.assert_not_called()
+
+    # after a write the old snapshot is still served while the new one is published
+    snapshot_database.get_version.return_value = 2
+    snapshot_database.get_products_fields.return_value = snapshot_products[:1]
+    assert current(first).version == 1
+    assert len(current(second).find_products()) == 1
+    assert current(first).version == 2
+    assert snapshot_database.get_products_fields.call_count == 1
+
+
+def test_shared_snapshot_bounded_lag(tmp_path, snapshot_database):
+    path = str(tmp_path / "catalog.snapshot")
+    write_snapshot(path, [], 1)
+    snapshot_database.get_version.return_value = 2
+
+    # built recently: no rebuild yet, the snapshot is served
+    shared = SharedSnapshot(path, snapshot_database, refresh_seconds=60, max_lag_seconds=60)
+    assert current(shared).version == 1
+    snapshot_database.get_products_fields.assert_not_called()
+
+    # too old to be served: MongoDB answers until the rebuild is published
+    shared = SharedSnapshot(path, snapshot_database, refresh_seconds=0, max_lag_seconds=-1)
+    assert current(shared) == None
+    snapshot_database.get_products_fields.assert_called_once()
+    assert read_version(path) == 2
@@ -0,0 +1,488 @@
+import pytest
+from unittest.mock import MagicMock
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes.database_interface import DatabaseInterface, MissingIndexes
+from classes.cache import TTLCache
+from classes.id_allocator import IdAllocator
+from classes.user import User
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout, OperationFailure
+
+
+# -------------------------------
+# FIXTURY
+# -------------------------------
+
+@pytest.fixture
+def database():
+    # MongoClient connects lazily, so no server is needed as long as collections are mocked
+    db = DatabaseInterface("mongodb://localhost:27017/", "gazetka_test")
+    collections = {}
+    db.database = MagicMock()
+    db.database.__getitem__.side_effect = lambda name: collections.setdefault(name, MagicMock())
+    return db
+
+
+# -------------------------------
+# TEST: products_query
+# -------------------------------
+def test_products_query_empty(database):
+    assert database.products_query() == {}
+
+
+def test_products_query_filters(database):
+    query = database.products_query(category="Nabiał", store_id=7, city="Warsaw",
+                                    min_price=2.5, expires_before="2025-12-31")
+    assert query == {
+        "category" : "Nabiał",
+        "store_id" : 7,
+        "city" : "Warsaw",
+        "price_users" : {"$gte" : 2.5},
+        "exp_date" : {"$lte" : "2025-12-31"}
+    }
+
+
+# -------------------------------
+# TEST: find_products
+# -------------------------------
+def test_find_products_page(database):
+    collection = database.database["products"]
+    cursor = collection.find.return_value.sort.return_value
+    cursor.limit.return_value = [{"id" : "p3"}]
+
+    result = database.find_products({"category" : "Food"}, limit=1, after="p2", fields=["name"])
+
+    assert result == [{"id" : "p3"}]
+    collection.find.assert_called_once_with(
+        {"category" : "Food", "id" : {"$gt" : "p2"}},
+        {"_id" : 0, "id" : 1, "name" : 1}
+    )
+    cursor.limit.assert_called_once_with(1)
+
+
+# -------------------------------
+# TEST: find_products_near
+# -------------------------------
+def _product(id, lat, lon, price_original, price_users):
+    return {"id" : id, "location" : [lat, lon], "price_original" : price_original, "price_users" : price_users}
+
+
+def test_find_products_near_in_memory_fallback(database):
+    collection = database.database["products"]
+    collection.aggregate.side_effect = OperationFailure("unable to find index for $geoNear query", code=291)
+    collection.find.return_value = [
+        _product("far", 50.06, 19.94, 10, 5),
+        _product("near", 52.23, 21.02, 10, 9),
+        _product("nearest", 52.2297, 21.0122, 10, 8),
+        _product("close", 52.25, 21.05, 10, 2),
+    ]
+
+    result = database.find_products_near(52.2297, 21.0122, 10, 10)
+    assert [p["id"] for p in result] == ["nearest", "near", "close"]
+    assert result[0]["distance"] < 0.01
+
+    result = database.find_products_near(52.2297, 21.0122, 10, 2, by_score=True)
+    assert [p["id"] for p in result] == ["close", "nearest"]
+
+
+def test_find_products_near_other_errors_surface(database):
+    collection = database.database["products"]
+    collection.aggregate.side_effect = ExecutionTimeout("operation exceeded time limit", code=50)
+
+    with pytest.raises(ExecutionTimeout):
+        database.find_products_near(52.2, 21.0, 3, 5)
+    collection.find.assert_not_called()
+
+
+def test_find_products_near_indexed(database):
+    collection = database.database["products"]
+    collection.aggregate.return_value = [{"id" : "p1", "distance" : 0.5}]
+
+    result = database.find_products_near(52.2, 21.0, 3, 5, query={"category" : "Food"})
+
+    assert result == [{"id" : "p1", "distance" : 0.5}]
+    pipeline = collection.aggregate.call_args[0][0]
+    assert pipeline[0]["$geoNear"]["near"]["coordinates"] == [21.0, 52.2]
+    assert pipeline[0]["$geoNear"]["maxDistance"] == 3000
+    assert pipeline[0]["$geoNear"]["query"] == {"category" : "Food"}
+    assert {"$limit" : 5} in pipeline
+
+
+# -------------------------------
+# TEST: get_stores
+# -------------------------------
+def test_get_stores_single_query(database):
+    collection = database.database["stores"]
+    collection.find.return_value = [
+        {"id" : 1, "name" : "A", "location" : [52.2, 21.0], "password" : "p", "points" : 3},
+        {"id" : 2, "name" : "B", "location" : [50.0, 19.9], "password" : "p", "points" : 0},
+    ]
+
+    stores = database.get_stores({1, 2})
+
+    assert set(stores.keys()) == {1, 2}
+    assert stores[1].name == "A"
+    collection.find.assert_called_once()
+    assert sorted(collection.find.call_args[0][0]["id"]["$in"]) == [1, 2]
+
+
+# -------------------------------
+# TEST: entity cache
+# -------------------------------
+STORE_DOC = {"id" : 1, "name" : "A", "location" : [52.2, 21.0], "password" : "p", "points" : 3}
+
+
+def test_get_store_is_cached(database):
+    collection = database.database["stores"]
+    collection.find.return_value = [dict(STORE_DOC)]
+
+    assert database.get_store(1).name == "A"
+    assert database.get_store(1).name == "A"
+
+    collection.find.assert_called_once()
+    assert database.get_cache_stats()["stores"]["hits"] == 1
+
+
+def test_update_store_points_invalidates(database):
+    collection = database.database["stores"]
+    collection.find.return_value = [dict(STORE_DOC)]
+    store = database.get_store(1)
+
+    store.add_points(5)
+    database.update_store_points(store)
+    collection.find.return_value = [dict(STORE_DOC, points=8)]
+
+    assert database.get_store(1).get_points() == 8
+    assert collection.find.call_count == 2
+
+
+def test_delete_invalidates(database):
+    collection = database.database["products"]
+    database.caches["products"].set("p1", {"id" : "p1"})
+    database.caches["products"].set("p2", {"id" : "p2"})
+
+    database.delete("products", {"id" : "p1"})
+    assert database.caches["products"].get("p1") == None
+    assert database.caches["products"].get("p2") != None
+
+    database.delete("products", {"store_id" : 1})
+    assert len(database.caches["products"]) == 0
+
+
+def test_ttl_cache_expires_and_evicts():
+    now = [0]
+    cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("c", 3)
+    assert cache.get("a") == None
+    assert cache.get("b") == 2
+
+    now[0] = 11
+    assert cache.get("b") == None
+    assert cache.get_stats() == {"size" : 1, "hits" : 1, "misses" : 2, "evictions" : 1}
+
+
+# -------------------------------
+# TEST: purchase
+# -------------------------------
+def test_purchase_guards_quantity_and_increments_points(database):
+    database.database["qr_codes"].find.return_value = [{"code" : "c1", "user" : "jan"}]
+    products = database.database["products"]
+    products.find_one_and_update.return_value = {"id" : "p1", "store_id" : 7, "quantity" : 1,
+                                                 "price_original" : 10, "price_users" : 5}
+    database.database["users"].find_one_and_update.return_value = {"points" : 1000}
+    database.database["stores"].find_one_and_update.return_value = {"points" : 11}
+
+    result = database.purchase("c1", "p1", 2)
+
+    assert result == {"store_id" : 7, "store_points" : 11, "user_points" : 1000}
+    assert products.find_one_and_update.call_args[0][:2] == (
+        {"id" : "p1", "quantity" : {"$gte" : 2}}, {"$inc" : {"quantity" : -2}})
+    assert database.database["users"].find_one_and_update.call_args[0][1] == {"$inc" : {"points" : 1000}}
+    assert database.database["stores"].find_one_and_update.call_args[0][1] == {"$inc" : {"points" : 10}}
+    products.delete_one.assert_not_called()
+
+
+def test_purchase_not_enough_quantity(database):
+    database.database["qr_codes"].find.return_value = [{"code" : "c1", "user" : "jan"}]
+    database.database["products"].find_one_and_update.return_value = None
+    database.database["products"].find_one.return_value = {"id" : "p1", "quantity" : 1}
+
+    assert database.purchase("c1", "p1", 2) == {"error" : "not_enough_quantity"}
+    database.database["users"].find_one_and_update.assert_not_called()
+
+
+def test_purchase_user_gone_gives_stock_back(database):
+    database.database["qr_codes"].find.return_value = [{"code" : "c1", "user" : "jan"}]
+    database.supports_transactions = MagicMock(return_value=False)
+    products = database.database["products"]
+    products.find_one_and_update.return_value = {"id" : "p1", "store_id" : 7, "quantity" : 1,
+                                                 "price_original" : 10, "price_users" : 5}
+    database.database["stores"].find_one_and_update.return_value = {"points" : 11}
+    database.database["users"].find_one_and_update.return_value = None
+
+    assert database.purchase("c1", "p1", 2) == {"error" : "user_not_existing"}
+    products.update_one.assert_called_once_with({"id" : "p1"}, {"$inc" : {"quantity" : 2}})
+    database.database["stores"].update_one.assert_called_once_with({"id" : 7}, {"$inc" : {"points" : -10}})
+    products.delete_one.assert_not_called()
+
+
+def test_purchase_store_gone_aborts_transaction(database):
+    database.database["qr_codes"].find.return_value = [{"code" : "c1", "user" : "jan"}]
+    database.supports_transactions = MagicMock(return_value=True)
+    database.client = MagicMock()
+    session = database.client.start_session.return_value.__enter__.return_value
+    session.with_transaction.side_effect = lambda callback: callback(session)
+    database.database["products"].find_one_and_update.return_value = {"id" : "p1", "store_id" : 7, "quantity" : 1,
+                                                                       "price_original" : 10, "price_users" : 5}
+    database.database["stores"].find_one_and_update.return_value = None
+
+    assert database.purchase("c1", "p1", 2) == {"error" : "store_not_existing"}
+    # the aborted transaction takes the decrement back, nothing is reverted by hand
+    database.database["products"].update_one.assert_not_called()
+    database.database["users"].find_one_and_update.assert_not_called()
+
+
+# -------------------------------
+# TEST: checkout
+# -------------------------------
+@pytest.fixture
+def basket(database):
+    database.database["qr_codes"].find.return_value = [{"code" : "c1", "user" : "jan"}]
+    database.database["products"].find.return_value = [
+        {"id" : "p1", "store_id" : 7, "quantity" : 5, "price_original" : 10, "price_users" : 5},
+        {"id" : "p2", "store_id" : 7, "quantity" : 1, "price_original" : 4, "price_users" : 2},
+    ]
+    database.database["users"].find_one_and_update.return_value = {"points" : 1400}
+    database.database["stores"].find_one_and_update.return_value = {"points" : 30}
+    return database
+
+
+def test_checkout_buys_whole_basket(basket):
+    result = basket.checkout("c1", {"p1" : 2, "p2" : 1})
+
+    assert result == {"stores" : [{"store_id" : 7, "store_points" : 30}], "user_points" : 1400}
+    products = basket.database["products"]
+    assert products.find.call_count == 1
+    assert products.update_one.call_count == 2
+    assert basket.database["users"].find_one_and_update.call_args[0][1] == {"$inc" : {"points" : 1200}}
+    assert basket.database["stores"].find_one_and_update.call_args[0][1] == {"$inc" : {"points" : 15}}
+    products.delete_many.assert_called_once()
+
+
+def test_checkout_store_gone_gives_basket_back(basket):
+    basket.supports_transactions = MagicMock(return_value=False)
+    basket.database["products"].update_one.return_value.matched_count = 1
+    basket.database["stores"].find_one_and_update.return_value = None
+
+    assert basket.checkout("c1", {"p1" : 2, "p2" : 1}) == {"error" : "store_not_existing"}
+    restored = [c[0] for c in basket.database["products"].update_one.call_args_list[2:]]
+    assert restored == [({"id" : "p1"}, {"$inc" : {"quantity" : 2}}), ({"id" : "p2"}, {"$inc" : {"quantity" : 1}})]
+    basket.database["users"].update_one.assert_called_once_with({"username" : "jan"}, {"$inc" : {"points" : -1200}})
+    basket.database["products"].delete_many.assert_not_called()
+
+
+def test_checkout_gives_back_items_on_conflict(basket):
+    products = basket.database["products"]
+    products.update_one.side_effect = [MagicMock(matched_count=1), MagicMock(matched_count=0)]
+
+    assert basket.checkout("c1", {"p1" : 2, "p2" : 1}) == {"error" : "not_enough_quantity"}
+
+    compensation = products.bulk_write.call_args[0][0]
+    assert len(compensation) == 1
+    assert compensation[0]._filter == {"id" : "p1"}
+    assert compensation[0]._doc == {"$inc" : {"quantity" : 2}}
+    basket.database["users"].find_one_and_update.assert_not_called()
+
+
+def test_checkout_checks_basket_first(basket):
+    assert basket.checkout("c1", {"p1" : 2, "p3" : 1}) == {"error" : "product_not_existing", "product_id" : "p3"}
+    assert basket.checkout("c1", {"p2" : 2}) == {"error" : "not_enough_quantity", "product_id" : "p2"}
+    basket.database["products"].update_one.assert_not_called()
+
+
+# -------------------------------
+# TEST: indexes
+# -------------------------------
+def test_ensure_indexes_reports_failures(database):
+    database.database["users"].create_index.side_effect = OperationFailure("duplicate key", code=11000)
+
+    failed = database.ensure_indexes()
+
+    assert failed == [("users", [("username", 1)])]
+    database.database["products"].create_index.assert_any_call([("id", 1)], unique=True)
+
+
+def test_ensure_indexes_replaces_conflicting_index(database):
+    stores = database.database["stores"]
+    stores.create_index.side_effect = [OperationFailure("conflict", code=85), None, None, None]
+
+    assert database.ensure_indexes({"stores" : [([("id", 1)], {"unique" : True})]}) == []
+    stores.drop_index.assert_called_once_with([("id", 1)])
+
+
+def test_missing_indexes(database):
+    database.database["qr_codes"].index_information.return_value = {
+        "_id_" : {"key" : [("_id", 1)]},
+        "code_1" : {"key" : [("code", 1)]},
+    }
+    indexes = {"qr_codes" : [([("code", 1)], {"unique" : True})]}
+    assert database.missing_indexes(indexes) == [("qr_codes", [("code", 1)])]
+
+    database.database["qr_codes"].index_information.return_value["code_1"]["unique"] = True
+    assert database.missing_indexes(indexes) == []
+
+
+def test_require_unique_indexes(database):
+    for name in ("users", "stores", "products", "qr_codes"):
+        database.database[name].index_information.return_value = {"id_1" : {"key" : [("id", 1)], "unique" : True}}
+    # every unique index but the usernames one exists
+    database.database["qr_codes"].index_information.return_value = {"code_1" : {"key" : [("code", 1)], "unique" : True}}
+    database.database["geocode_cache"].index_information.return_value = {"key_1" : {"key" : [("key", 1)], "unique" : True}}
+
+    with pytest.raises(MissingIndexes) as error:
+        database.require_unique_indexes()
+    assert error.value.missing == [("users", [("username", 1)])]
+
+    database.database["users"].index_information.return_value = {"username_1" : {"key" : [("username", 1)], "unique" : True}}
+    database.require_unique_indexes()
+
+
+def test_ensure_indexes_drops_obsolete(database):
+    products = database.database["products"]
+    products.drop_index.side_effect = [None, OperationFailure("index not found", code=27), None]
+
+    assert database.ensure_indexes() == []
+    products.drop_index.assert_any_call([("exp_date", 1), ("id", 1)])
+    products.drop_index.assert_any_call([("category", 1), ("id", 1)])
+    products.create_index.assert_any_call([("category", 1), ("id", 1), ("price_users", 1)])
+
+
+# -------------------------------
+# TEST: fill_store_places / fill_product_places
+# -------------------------------
+def test_fill_places_without_old_documents(database):
+    database.database["stores"].find.return_value = []
+    database.database["products"].distinct.return_value = []
+
+    database.fill_store_places()
+    database.fill_product_places()
+
+    database.database["products"].update_many.assert_not_called()
+    database.database["counters"].find_one_and_update.assert_not_called()
+
+
+def test_fill_product_places_only_affected_stores(database):
+    products = database.database["products"]
+    products.distinct.return_value = [2]
+    database.database["stores"].find.return_value = [
+        {"id" : 2, "name" : "B", "location" : [52.2, 21.0], "password" : "p", "points" : 0,
+         "city" : "Warsaw", "province" : "Masovian Voivodeship"}
+    ]
+
+    database.fill_product_places()
+
+    database.database["stores"].find.assert_called_once_with({"id" : {"$in" : [2]}})
+    assert products.update_many.call_args_list[0][0] == ({"store_id" : 2, "city" : {"$exists" : False}},
+                                                         {"$set" : {"city" : "Warsaw"}})
+    database.database["counters"].find_one_and_update.assert_called_once()
+
+
+def test_add_product_existing_increments(database):
+    product = MagicMock()
+    product.id = "p1"
+    product.quantity = 3
+    database.database["products"].insert_one.side_effect = DuplicateKeyError("dup")
+
+    database.add_product(product)
+
+    database.database["products"].update_one.assert_called_once_with({"id" : "p1"}, {"$inc" : {"quantity" : 3}})
+
+
+# -------------------------------
+# TEST: versions
+# -------------------------------
+def test_writes_bump_version(database):
+    counters = database.database["counters"]
+    counters.find_one.return_value = None
+    assert database.get_version("products") == 0
+
+    counters.find_one_and_update.return_value = {"_id" : "version_products", "value" : 4}
+    seen = []
+    database.product_listeners.append(lambda ids, version: seen.append((ids, version)))
+    database.delete("products", {"id" : "p1"})
+    assert counters.find_one_and_update.call_args[0] == ({"_id" : "version_products"}, {"$inc" : {"value" : 1}})
+    # listeners get the exact version their write produced
+    assert seen == [(["p1"], 4)]
+
+    database.delete("qr_codes", {"code" : "c1"})
+    assert counters.find_one_and_update.call_count == 1
+
+
+# -------------------------------
+# TEST: bulk_upsert_products
+# -------------------------------
+def test_bulk_upsert_products(database):
+    products = []
+    for id, quantity in [("p1", 3), ("p2", 5)]:
+        product = MagicMock()
+        product.id = id
+        product.prepare_dict.return_value = {"id" : id, "name" : "Mleko", "quantity" : quantity}
+        products.append(product)
+    database.database["products"].bulk_write.side_effect = BulkWriteError(
+        {"writeErrors" : [{"index" : 1, "errmsg" : "boom"}]})
+
+    errors = database.bulk_upsert_products(products)
+
+    assert errors == {1 : "boom"}
+    operations = database.database["products"].bulk_write.call_args.args[0]
+    assert database.database["products"].bulk_write.call_args.kwargs == {"ordered" : False}
+    assert operations[0]._filter == {"id" : "p1"}
+    assert operations[0]._doc == {"$setOnInsert" : {"id" : "p1", "name" : "Mleko"}, "$inc" : {"quantity" : 3}}
+    assert operations[0]._upsert == True
+
+
+# -------------------------------
+# TEST: IdAllocator
+# -------------------------------
+def test_id_allocator_leases_blocks():
+    mock_db = MagicMock()
+    mock_db.lease_ids.side_effect = [10, 30]
+    allocator = IdAllocator("stores", block_size=10)
+
+    ids = [allocator.allocate(mock_db) for _ in range(12)]
+
+    assert ids == list(range(0, 10)) + [20, 21]
+    assert mock_db.lease_ids.call_count == 2
+
+
+def test_lease_ids_increments_counter(database):
+    counters = database.database["counters"]
+    counters.find_one_and_update.return_value = {"_id" : "stores", "value" : 110}
+
+    assert database.lease_ids("stores", 10) == 110
+    assert counters.find_one_and_update.call_args[0][:2] == ({"_id" : "stores"}, {"$inc" : {"value" : 10}})
+
+
+# -------------------------------
+# TEST: add_user
+# -------------------------------
+def test_add_user_free_name(database):
+    user = User("jan", "jan@mock", "pass")
+
+    assert database.add_user(user).username == "jan"
+    database.database["users"].find.assert_not_called()
+
+
+def test_add_user_taken_name_gets_next_suffix(database):
+    users = database.database["users"]
+    users.insert_one.side_effect = [DuplicateKeyError("dup"), None]
+    users.find.return_value = [{"username" : "jan0"}, {"username" : "jan3"}]
+
+    assert database.add_user(User("jan", "jan@mock", "pass")).username == "jan4"
+    assert users.find.call_args[0][0] == {"username" : {"$regex" : "^jan[0-9]+$"}}
+    assert users.insert_one.call_args[0][0]["username"] == "jan4"
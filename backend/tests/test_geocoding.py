@@ -0,0 +1,132 @@
+import pytest
+from unittest.mock import MagicMock
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes.geocoding import OfflineGeocoder, GeocodeCache, NominatimGeocoder, cached_geocoder, make_geocoder, normalize_province, UNKNOWN
+from classes.store import Store
+from classes.utils import Location
+
+
+# -------------------------------
+# FIXTURY
+# -------------------------------
+
+@pytest.fixture(scope="module")
+def geocoder():
+    return OfflineGeocoder()
+
+
+# -------------------------------
+# TEST: reverse
+# -------------------------------
+@pytest.mark.parametrize("coords, city, province", [
+    ((52.23, 21.01), "Warsaw", "Masovian Voivodeship"),
+    ((50.06, 19.94), "Kraków", "Lesser Poland Voivodeship"),
+    ((54.35, 18.65), "Gdańsk", "Pomeranian Voivodeship"),
+    ((50.87, 20.63), "Kielce", "Holy Cross Voivodeship"),
+])
+def test_reverse_known_city(geocoder, coords, city, province):
+    result = geocoder.reverse(*coords)
+    assert result["city"] == city
+    assert result["province"] == province
+
+
+def test_reverse_outside_poland(geocoder):
+    assert geocoder.reverse(70, 21) == {"city" : UNKNOWN, "province" : UNKNOWN}
+    assert geocoder.reverse(10.0, 20.0)["city"] == UNKNOWN
+
+
+def test_reverse_matches_brute_force(geocoder):
+    localities = [l for cell in geocoder.cells.values() for l in cell]
+    for lat, lon in [(51.5, 19.0), (53.0, 17.2), (50.3, 22.9), (52.6, 15.4)]:
+        nearest = geocoder.nearest(lat, lon)
+        brute = min(localities, key=lambda l: (l[0] - lat) ** 2 + ((l[1] - lon) * 0.63) ** 2)
+        assert nearest[2] == brute[2]
+
+
+# -------------------------------
+# TEST: Location
+# -------------------------------
+def test_location_uses_offline_geocoder_by_default():
+    location = Location(51.11, 17.03)
+    assert location.get_city() == "Wrocław"
+    assert location.get_province() == "Lower Silesian Voivodeship"
+
+
+# -------------------------------
+# TEST: normalize_province
+# -------------------------------
+def test_normalize_province():
+    assert normalize_province("mazowieckie") == "Masovian Voivodeship"
+    assert normalize_province("Slaskie") == "Silesian Voivodeship"
+    assert normalize_province("Masovian Voivodeship") == "Masovian Voivodeship"
+    assert normalize_province("nowhere") == "nowhere"
+
+
+# -------------------------------
+# TEST: GeocodeCache
+# -------------------------------
+def test_geocode_cache_memory_tier():
+    inner = MagicMock()
+    inner.reverse.return_value = {"city" : "Warsaw", "province" : "Masovian Voivodeship"}
+    cache = GeocodeCache(inner)
+
+    assert cache.reverse(52.22971, 21.01221)["city"] == "Warsaw"
+    assert cache.reverse(52.22969, 21.01219)["city"] == "Warsaw"
+    inner.reverse.assert_called_once()
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_geocode_cache_database_tier():
+    inner = MagicMock()
+    mock_db = MagicMock()
+    mock_db.get_cached_place.return_value = {"city" : "Radom", "province" : "Masovian Voivodeship"}
+    cache = GeocodeCache(inner, mock_db)
+
+    assert cache.reverse(51.4, 21.15)["city"] == "Radom"
+    inner.reverse.assert_not_called()
+
+    mock_db.get_cached_place.return_value = None
+    inner.reverse.return_value = {"city" : "Kielce", "province" : "Holy Cross Voivodeship"}
+    cache.reverse(50.87, 20.63)
+    mock_db.cache_place.assert_called_once_with("50.87,20.63", inner.reverse.return_value)
+
+
+def test_database_tier_only_for_nominatim(geocoder):
+    mock_db = MagicMock()
+    assert cached_geocoder(geocoder, mock_db).database == None
+    assert cached_geocoder(MagicMock(spec=NominatimGeocoder), mock_db).database == mock_db
+
+
+def test_make_geocoder():
+    assert isinstance(make_geocoder("offline"), OfflineGeocoder)
+    assert isinstance(make_geocoder("nominatim"), NominatimGeocoder)
+    with pytest.raises(ValueError):
+        make_geocoder("google")
+
+
+def test_geocode_cache_evicts_least_recently_used():
+    inner = MagicMock()
+    inner.reverse.return_value = {"city" : "X", "province" : "Y"}
+    cache = GeocodeCache(inner, maxsize=2)
+    cache.reverse(1, 1)
+    cache.reverse(2, 2)
+    cache.reverse(1, 1)
+    cache.reverse(3, 3)
+    assert list(cache.entries.keys()) == ["1.0,1.0", "3.0,3.0"]
+
+
+def test_store_from_database_reads_saved_place():
+    geocoder = MagicMock()
+    store = Store.from_database({
+        "id" : 1, "name" : "S", "location" : [52.2, 21.0], "password" : "p", "points" : 0,
+        "city" : "Warsaw", "province" : "Masovian Voivodeship"
+    })
+    store.location.geocoder = geocoder
+    d = store.prepare_dict()
+    assert d["city"] == "Warsaw"
+    assert d["province"] == "Masovian Voivodeship"
+    geocoder.reverse.assert_not_called()
@@ -0,0 +1,77 @@
+import pytest
+from types import SimpleNamespace
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes.metrics import Histogram, Metrics
+from classes.database_interface import CommandMetrics
+
+
+# -------------------------------
+# FIXTURY
+# -------------------------------
+
+@pytest.fixture
+def metrics():
+    return Metrics()
+
+
+def command_events(name, command, request_id, duration_micros):
+    started = SimpleNamespace(command_name=name, command=command, request_id=request_id)
+    finished = SimpleNamespace(command_name=name, request_id=request_id, duration_micros=duration_micros)
+    return started, finished
+
+
+# -------------------------------
+# TEST: Histogram
+# -------------------------------
+def test_histogram_render_is_cumulative():
+    histogram = Histogram((0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value)
+
+    assert histogram.render("x", [("route", "/a")]) == [
+        'x_bucket{route="/a",le="0.1"} 1',
+        'x_bucket{route="/a",le="1.0"} 3',
+        'x_bucket{route="/a",le="+Inf"} 4',
+        'x_sum{route="/a"} 4.25',
+        'x_count{route="/a"} 4',
+    ]
+
+
+# -------------------------------
+# TEST: Metrics / CommandMetrics
+# -------------------------------
+def test_commands_are_attributed_to_request(metrics):
+    listener = CommandMetrics(metrics)
+    stats = metrics.begin_request()
+    for request_id, (name, command) in enumerate([("find", {"find" : "qr_codes"}),
+                                                  ("findAndModify", {"findAndModify" : "products"}),
+                                                  ("getMore", {"getMore" : 12, "collection" : "products"})]):
+        started, finished = command_events(name, command, request_id, 2000)
+        listener.started(started)
+        listener.succeeded(finished)
+    started, finished = command_events("update", {"update" : "users"}, 9, 1000)
+    listener.started(started)
+    listener.failed(finished)
+
+    assert stats.commands == 4
+    assert stats.mongo_seconds == pytest.approx(0.007)
+    metrics.observe_request("/buy-product", "POST", 200, 0.02, stats)
+
+    text = metrics.render()
+    assert 'gazetka_request_duration_seconds_count{route="/buy-product",method="POST",status="200"} 1' in text
+    assert 'gazetka_request_mongo_commands_bucket{route="/buy-product",method="POST",le="5.0"} 1' in text
+    assert 'gazetka_mongo_command_duration_seconds_count{collection="products",command="getMore"} 1' in text
+    assert 'gazetka_mongo_command_failures_total{collection="users",command="update"} 1' in text
+    assert listener.started_commands == {}
+
+
+def test_commands_outside_request(metrics):
+    started, finished = command_events("createIndexes", {"createIndexes" : "stores"}, 1, 500)
+    listener = CommandMetrics(metrics)
+    listener.started(started)
+    listener.succeeded(finished)
+    assert 'collection="stores",command="createIndexes"' in metrics.render()
@@ -99,6 +99,29 @@ def test_from_database(mock_store):
     mock_db.get_store.assert_called_once_with(mock_store.id)
 
 
+def test_from_database_with_store(mock_store):
+    mock_db = MagicMock(spec=DatabaseInterface)
+    doc = {
+        "id": "custom_id",
+        "name": "Chleb",
+        "series": "X1",
+        "price_original": 4.0,
+        "price_users": 2.0,
+        "exp_date": "2025-02-02",
+        "EAN": "1112223334445",
+        "category": "Pieczywo",
+        "store_id": mock_store.id,
+        "quantity": 10,
+        "photo_url": "url"
+    }
+
+    p = Product.from_database(doc, mock_db, mock_store)
+
+    assert p.store == mock_store
+    assert p.id == "custom_id"
+    mock_db.get_store.assert_not_called()
+
+
 # -------------------------------
 # TEST: get_location_coords
 # -------------------------------
@@ -153,26 +176,29 @@ def test_update_quantity(sample_product):
 # -------------------------------
 def test_get_all_products(mock_store):
     mock_db = MagicMock(spec=DatabaseInterface)
-    mock_db.get_store.return_value = mock_store
+    mock_db.get_stores.return_value = {mock_store.id : mock_store}
 
-    mock_db.get_all_products.return_value = [
-        {
-            "name": "Masło",
-            "series": "M1",
-            "price_original": 8,
-            "price_users": 5,
-            "exp_date": "2025-02-02",
-            "EAN": "0001112223334",
-            "category": "Nabiał",
-            "store_id": mock_store.id,
-            "quantity": 2,
-            "photo_url": "url"
-        }
-    ]
+    record = {
+        "name": "Masło",
+        "series": "M1",
+        "price_original": 8,
+        "price_users": 5,
+        "exp_date": "2025-02-02",
+        "EAN": "0001112223334",
+        "category": "Nabiał",
+        "store_id": mock_store.id,
+        "quantity": 2,
+        "photo_url": "url"
+    }
+    orphan = dict(record, store_id="S404")
+    mock_db.get_all_products.return_value = [record, dict(record, series="M2"), orphan]
 
     products = get_all_products(mock_db)
 
-    assert len(products) == 1
+    assert len(products) == 2
     assert isinstance(products[0], Product)
     assert products[0].name == "Masło"
+    assert products[0].store is products[1].store
     mock_db.get_all_products.assert_called_once()
+    mock_db.get_stores.assert_called_once_with({mock_store.id, "S404"})
+    mock_db.get_store.assert_not_called()
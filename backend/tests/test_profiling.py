@@ -0,0 +1,78 @@
+import pytest
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes.profiling import RequestProfiler, parse_profile_name, profile_name
+
+
+# -------------------------------
+# FIXTURY
+# -------------------------------
+
+@pytest.fixture
+def profiler(tmp_path):
+    return RequestProfiler(str(tmp_path / "profiles"), token="secret", max_files=2)
+
+
+def profiled_request(profiler, route, request_id):
+    profile = profiler.begin("secret")
+    sorted(range(1000), key=lambda x: -x)
+    name = profile_name(route, request_id)
+    profiler.finish(profile, name)
+    return name
+
+
+# -------------------------------
+# TEST: begin
+# -------------------------------
+def test_profiling_is_opt_in(profiler):
+    assert profiler.begin(None) == None
+    assert profiler.begin("wrong") == None
+
+    profile = profiler.begin("secret")
+    assert profile != None
+    # only one request is profiled at a time
+    assert profiler.begin("secret") == None
+    profiler.finish(profile, profile_name("/a", "1"))
+
+
+def test_numeric_token(tmp_path):
+    # GAZETKA_PROFILE_TOKEN=1234 reaches the config as an int
+    profiler = RequestProfiler(str(tmp_path), token=1234)
+    assert profiler.authorized("1234") == True
+    assert profiler.authorized("12345") == False
+    assert RequestProfiler(str(tmp_path)).authorized("None") == False
+
+
+def test_sample_rate(tmp_path):
+    assert RequestProfiler(str(tmp_path), sample_rate=1.0).wanted(None) == True
+    assert RequestProfiler(str(tmp_path)).wanted("anything") == False
+
+
+# -------------------------------
+# TEST: files
+# -------------------------------
+def test_profile_name_round_trip():
+    stamp, route, request_id = parse_profile_name(profile_name("/products/bulk", "ab-12"))
+    assert route == "products_bulk"
+    assert request_id == "ab-12"
+
+
+def test_recent_profiles_rotate(profiler):
+    names = [profiled_request(profiler, "/products", str(i)) for i in range(3)]
+
+    recent = profiler.recent()
+    assert [p["request_id"] for p in recent] == ["2", "1"]
+    assert recent[0]["name"] == names[2]
+    assert recent[0]["route"] == "products"
+
+
+def test_summary(profiler):
+    name = profiled_request(profiler, "/products", "1")
+
+    summary = profiler.summary(name, top=5)
+    assert len(summary["functions"]) <= 5
+    assert any("sorted" in f["function"] for f in profiler.summary(name, top=100)["functions"])
+    assert profiler.summary("../../etc/passwd") == None
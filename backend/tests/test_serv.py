@@ -1,5 +1,5 @@
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock
 from flask import json
 import sys
 import os
@@ -7,29 +7,67 @@ from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 import server as flask_app_module
+from classes.database_interface import MissingIndexes
+from classes.catalog_snapshot import write_snapshot
+from classes import geocoding
 
 
+# ---------------------------
+# MOCK DATABASE
+# ---------------------------
 @pytest.fixture
-def client():
-    flask_app_module.app.config['TESTING'] = True
-    with flask_app_module.app.test_client() as client:
+def mock_database():
+    mock_db = MagicMock()
+    mock_db.get_store.return_value = MagicMock()
+    mock_db.get_product.return_value = MagicMock()
+    mock_db.get_user_from_qr_code.return_value = MagicMock()
+    mock_db.get_user.return_value = MagicMock()
+    mock_db.find.return_value = []
+    mock_db.get_products_dicts.return_value = []
+    mock_db.get_all_stores.return_value = []
+    mock_db.find_products.return_value = []
+    mock_db.get_max_store_id.return_value = None
+    mock_db.lease_ids.return_value = 10
+    mock_db.get_cached_place.return_value = None
+    mock_db.get_version.return_value = 0
+    mock_db.get_cache_stats.return_value = {}
+    return mock_db
+
+
+@pytest.fixture
+def client(mock_database):
+    app = flask_app_module.create_app({"TESTING" : True}, database=mock_database)
+    with app.test_client() as client:
         yield client
 
 
 # ---------------------------
-# MOCK DATABASE
+# TEST startup
 # ---------------------------
-@pytest.fixture(autouse=True)
-def mock_database():
-    with patch.object(flask_app_module, "database") as mock_db:
-        mock_db.get_store.return_value = MagicMock()
-        mock_db.get_product.return_value = MagicMock()
-        mock_db.get_user_from_qr_code.return_value = MagicMock()
-        mock_db.get_user.return_value = MagicMock()
-        mock_db.find.return_value = []
-        mock_db.get_products_dicts.return_value = []
-        mock_db.get_all_stores.return_value = []
-        yield mock_db
+def test_refuses_to_serve_without_unique_indexes(client, mock_database):
+    mock_database.require_unique_indexes.side_effect = MissingIndexes([("users", [("username", 1)])])
+    with pytest.raises(MissingIndexes):
+        client.get("/all-stores")
+    mock_database.fill_store_places.assert_not_called()
+
+
+def test_started_state_skips_start_lock(client, mock_database):
+    client.get("/all-stores")
+    state = client.application.extensions["gazetka"]
+    state.start_lock = MagicMock()
+    client.get("/all-stores")
+    state.start_lock.__enter__.assert_not_called()
+    mock_database.ensure_indexes.assert_called_once()
+
+
+def test_nominatim_geocoder_uses_database_cache(mock_database, monkeypatch):
+    monkeypatch.setattr(geocoding, "_default_geocoder", None)
+    app = flask_app_module.create_app({"TESTING" : True, "GEOCODER" : "nominatim"}, database=mock_database)
+    with app.test_client() as client:
+        client.get("/all-stores")
+    installed = geocoding.get_default_geocoder()
+    assert isinstance(installed.geocoder, geocoding.NominatimGeocoder)
+    assert installed.database == mock_database
 
 
 # ---------------------------
@@ -48,17 +86,227 @@ def test_add_store(client, mock_database):
     assert data["name"] == "Test Store"
 
 
+# ---------------------------
+# TEST /stores-ranking
+# ---------------------------
+def test_stores_ranking(client, mock_database):
+    mock_database.get_all_stores.return_value = [
+        {"id": 1, "name": "A", "location": [52.2, 21.0], "password": "p", "points": 5,
+         "city": "Warsaw", "province": "Masovian Voivodeship"},
+        {"id": 2, "name": "B", "location": [50.0, 19.9], "password": "p", "points": 9,
+         "city": "Kraków", "province": "Lesser Poland Voivodeship"},
+    ]
+    response = client.get("/stores-ranking")
+    data = json.loads(response.data)
+    assert [r["store_id"] for r in data] == [2, 1]
+
+    response = client.get("/stores-ranking", query_string={"province": "mazowieckie"})
+    data = json.loads(response.data)
+    assert [r["store_id"] for r in data] == [1]
+
+    response = client.get("/store-rank", query_string={"store_id": 1})
+    data = json.loads(response.data)
+    assert data["place"] == 2
+    assert data["points"] == 5
+
+
 # ---------------------------
 # TEST /products
 # ---------------------------
 def test_get_products(client, mock_database):
-    mock_database.get_products_dicts.return_value = [{"id":"p1"}]
+    mock_database.find_products.return_value = [{"id":"p1"}]
     response = client.get("/products")
     data = json.loads(response.data)
     assert response.status_code == 200
     assert data[0]["id"] == "p1"
 
 
+def test_get_products_page(client, mock_database):
+    mock_database.find_products.return_value = [{"id":"p1"}, {"id":"p2"}]
+    response = client.get("/products", query_string={
+        "limit": 2, "after": "p0", "category": "Food", "fields": "name,price_users"
+    })
+    assert response.status_code == 200
+    assert response.headers["X-Next-Cursor"] == "p2"
+    args = mock_database.find_products.call_args[0]
+    assert args[1:] == (2, "p0", ["name", "price_users"])
+
+
+def test_get_products_from_snapshot(mock_database, tmp_path):
+    path = str(tmp_path / "catalog.snapshot")
+    write_snapshot(path, [
+        {"id" : "p1", "price_original" : 10, "price_users" : 5, "quantity" : 1, "store_id" : 1, "category" : "Food"},
+        {"id" : "p2", "price_original" : 10, "price_users" : 5, "quantity" : 1, "store_id" : 1, "category" : "Drinks"},
+    ], 0)
+    app = flask_app_module.create_app({"TESTING" : True, "CATALOG_SNAPSHOT_PATH" : path}, database=mock_database)
+    with app.test_client() as client:
+        response = client.get("/products", query_string={"category": "Food", "fields": "price_original"})
+    mock_database.find_products.assert_not_called()
+
+    # the same bytes (and ETag) as a worker answering from MongoDB
+    mock_database.find_products.return_value = [{"id" : "p1", "price_original" : 10}]
+    with flask_app_module.create_app({"TESTING" : True}, database=mock_database).test_client() as client:
+        from_mongo = client.get("/products", query_string={"category": "Food", "fields": "price_original"})
+    assert response.data == from_mongo.data
+    assert response.headers["ETag"] == from_mongo.headers["ETag"]
+
+
+def test_get_products_wrong_date(client, mock_database):
+    for value in ["garbage", "2025-13-01", "2025-1-1", "2025-01-01T00:00"]:
+        response = client.get("/products", query_string={"expires_before": value})
+        assert json.loads(response.data) == {"error": "wrong_date", "argument": "expires_before"}
+    mock_database.find_products.assert_not_called()
+
+
+# ---------------------------
+# TEST streaming (NDJSON)
+# ---------------------------
+def test_get_products_stream(client, mock_database):
+    mock_database.iter_products.return_value = iter([{"id":"p1"}, {"id":"p2"}])
+    response = client.get("/products", query_string={"category": "Food"},
+                          headers={"Accept": "application/x-ndjson"})
+    assert response.mimetype == "application/x-ndjson"
+    assert [json.loads(line) for line in response.data.decode().splitlines()] == [{"id":"p1"}, {"id":"p2"}]
+    mock_database.find_products.assert_not_called()
+
+
+def test_stores_stream(client, mock_database):
+    store = {"id": 1, "name": "A", "location": [52.2, 21.0], "password": "p", "points": 5,
+             "city": "Warsaw", "province": "Masovian Voivodeship"}
+    mock_database.get_all_stores.return_value = [store]
+    mock_database.iter_stores.return_value = iter([store])
+
+    response = client.get("/all-stores", query_string={"stream": 1})
+    lines = response.data.decode().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])["id"] == 1
+    assert "password" not in json.loads(lines[0])
+
+    response = client.get("/stores-ranking", query_string={"stream": 1, "limit": 1})
+    assert [json.loads(line)["store_id"] for line in response.data.decode().splitlines()] == [1]
+
+
+# ---------------------------
+# TEST ETag / versioned cache
+# ---------------------------
+def test_products_etag(client, mock_database):
+    mock_database.find_products.return_value = [{"id":"p1"}]
+    response = client.get("/products", query_string={"category": "Food"})
+    etag = response.headers["ETag"]
+
+    response = client.get("/products", query_string={"category": "Food"}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert mock_database.find_products.call_count == 1
+
+    mock_database.get_version.return_value = 1
+    mock_database.find_products.return_value = [{"id":"p2"}]
+    response = client.get("/products", query_string={"category": "Food"}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert json.loads(response.data) == [{"id":"p2"}]
+    assert response.headers["ETag"] != etag
+
+
+def test_stores_ranking_etag_changes_with_points(client, mock_database):
+    mock_database.get_all_stores.return_value = [
+        {"id": 1, "name": "A", "location": [52.2, 21.0], "password": "p", "points": 5,
+         "city": "Warsaw", "province": "Masovian Voivodeship"},
+    ]
+    etag = client.get("/stores-ranking").headers["ETag"]
+    assert client.get("/stores-ranking", headers={"If-None-Match": etag}).status_code == 304
+
+    mock_database.purchase.return_value = {"store_id": 1, "store_points": 20, "user_points": 10}
+    client.post("/buy-product", json={"code": "QR123", "product_id": "p1", "quantity": 1})
+    response = client.get("/stores-ranking", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert json.loads(response.data)[0]["points"] == 20
+
+
+# ---------------------------
+# TEST /metrics
+# ---------------------------
+def test_metrics(client, mock_database):
+    client.get("/validate-user", query_string={"username": "a", "password": "x"})
+    client.get("/validate-user", query_string={"username": "b", "password": "y"})
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    assert 'gazetka_request_duration_seconds_count{route="/validate-user",method="GET",status="200"} 2' in response.data.decode()
+
+
+def test_metrics_cache_stats(client, mock_database):
+    mock_database.get_cache_stats.return_value = {"users" : {"size" : 3, "hits" : 7, "misses" : 3, "evictions" : 1}}
+    client.get("/stores-ranking")
+    client.get("/stores-ranking")
+    text = client.get("/metrics").data.decode()
+    assert 'gazetka_cache_hits_total{cache="users"} 7' in text
+    assert 'gazetka_cache_evictions_total{cache="users"} 1' in text
+    assert 'gazetka_cache_hits_total{cache="responses"} 1' in text
+    assert 'gazetka_cache_size{cache="responses"} 1' in text
+
+
+# ---------------------------
+# TEST profiling
+# ---------------------------
+def test_profile_request(mock_database, tmp_path):
+    app = flask_app_module.create_app({"TESTING" : True, "PROFILE_TOKEN" : "secret",
+                                       "PROFILE_DIR" : str(tmp_path)}, database=mock_database)
+    client = app.test_client()
+
+    response = client.get("/stores-ranking", headers={"X-Request-ID": "r1"})
+    assert response.headers["X-Request-ID"] == "r1"
+    assert "X-Profile-Name" not in response.headers
+
+    response = client.get("/stores-ranking", headers={"X-Request-ID": "r2", "X-Profile": "secret"})
+    name = response.headers["X-Profile-Name"]
+
+    # the profiles are only shown with the token
+    assert client.get("/profiles").status_code == 403
+    assert client.get("/profiles/" + name, headers={"X-Profile": "wrong"}).status_code == 403
+
+    headers = {"X-Profile": "secret"}
+    profiles = json.loads(client.get("/profiles", headers=headers).data)
+    assert [(p["name"], p["route"], p["request_id"]) for p in profiles] == [(name, "stores-ranking", "r2")]
+    assert json.loads(client.get("/profiles/" + name, headers=headers).data)["name"] == name
+    assert json.loads(client.get("/profiles/missing.prof", headers=headers).data) == {"error": "profile_not_existing"}
+
+
+# ---------------------------
+# TEST /products-near
+# ---------------------------
+def test_get_products_near(client, mock_database):
+    mock_database.find_products_near.return_value = [{"id":"p1", "distance": 0.4}]
+    response = client.get("/products-near", query_string={"lat": 52.2, "lon": 21.0, "radius": 2, "sort": "score"})
+    data = json.loads(response.data)
+    assert response.status_code == 200
+    assert data[0]["id"] == "p1"
+    args = mock_database.find_products_near.call_args[0]
+    assert args[:5] == (52.2, 21.0, 2.0, 50, True)
+
+
+def test_get_products_near_without_coords(client, mock_database):
+    response = client.get("/products-near")
+    data = json.loads(response.data)
+    assert data["error"] == "missing_coordinates"
+
+
+# ---------------------------
+# TEST /best-deals
+# ---------------------------
+def test_best_deals(client, mock_database):
+    mock_database.get_products_fields.return_value = [
+        {"id": "p1", "price_original": 10, "price_users": 8, "quantity": 1, "exp_date": "2025-01-01",
+         "store_id": 1, "category": "Food"},
+        {"id": "p2", "price_original": 10, "price_users": 4, "quantity": 1, "exp_date": "2025-01-01",
+         "store_id": 1, "category": "Food"},
+    ]
+    mock_database.get_products_by_ids.return_value = [{"id": "p1", "name": "A"}, {"id": "p2", "name": "B"}]
+
+    response = client.get("/best-deals", query_string={"k": 2, "category": "Food"})
+    data = json.loads(response.data)
+    assert [p["id"] for p in data] == ["p2", "p1"]
+    assert data[0]["discount"] == 0.6
+    mock_database.get_products_by_ids.assert_called_once_with(["p2", "p1"])
+
+
 # ---------------------------
 # TEST /add-product
 # ---------------------------
@@ -85,21 +333,81 @@ def test_add_product(client, mock_database):
     assert data["received"]["store_name"] == "Mock Store"
 
 
+def test_add_and_update_product_unknown_store(client, mock_database):
+    mock_database.get_store.return_value = None
+
+    response = client.post("/add-product", json={"name": "Test Product", "store_id": 99, "quantity": 3})
+    assert json.loads(response.data) == {"error": "store_not_existing"}
+
+    response = client.post("/update-product", json={"id": "p1", "name": "Test Product", "store_id": "0"})
+    assert json.loads(response.data) == {"error": "store_not_existing"}
+    # the product is kept
+    mock_database.delete.assert_not_called()
+    mock_database.add_product.assert_not_called()
+
+
 # ---------------------------
-# TEST /buy-product
+# TEST /products/bulk
 # ---------------------------
-def test_buy_product(client, mock_database):
-    mock_user = MagicMock()
-    mock_user.get_points.return_value = 10
-    mock_product = MagicMock()
-    mock_product.calculate_score_for_one.return_value = 2
-    mock_product.quantity = 5
+def test_products_bulk_ndjson(client, mock_database):
     mock_store = MagicMock()
-    mock_store.get_points.return_value = 20
+    mock_store.id = 4
+    mock_database.get_store.return_value = mock_store
+    mock_database.bulk_upsert_products.return_value = {}
+    body = "\n".join([
+        json.dumps({"name": "Mleko", "series": "A", "price_original": 4, "price_users": 3,
+                    "exp_date": "2025-01-01", "EAN": "590", "category": "Nabiał", "quantity": 2}),
+        "{not json",
+        json.dumps({"name": "Chleb", "series": "B", "price_original": 5, "price_users": 4,
+                    "exp_date": "2025-01-02", "EAN": "591", "category": "Pieczywo", "quantity": 0}),
+    ])
+
+    response = client.post("/products/bulk?store_id=4", data=body, content_type="application/x-ndjson")
+    data = json.loads(response.data)
+
+    assert data["imported"] == 1
+    assert data["failed"] == 2
+    assert data["results"] == [
+        {"row": 1, "id": "4_590_A_300", "status": "ok"},
+        {"row": 2, "error": "invalid_json"},
+        {"row": 3, "error": "invalid_quantity"},
+    ]
+    mock_database.get_store.assert_called_once_with(4)
+    mock_database.bulk_upsert_products.assert_called_once()
 
-    mock_database.get_user_from_qr_code.return_value = mock_user
-    mock_database.get_product.return_value = mock_product
+
+def test_products_bulk_csv(client, mock_database):
+    mock_store = MagicMock()
+    mock_store.id = 4
     mock_database.get_store.return_value = mock_store
+    mock_database.bulk_upsert_products.return_value = {1: "write_error"}
+    body = ("name,series,price_original,price_users,exp_date,EAN,category,quantity\n"
+            "Mleko,A,4.0,3.0,2025-01-01,590,Nabiał,2\n"
+            "Ser,C,10,7.5,2025-01-03,592,Nabiał,1\n")
+
+    response = client.post("/products/bulk?store_id=4", data=body.encode("utf-8"), content_type="text/csv")
+    data = json.loads(response.data)
+
+    assert data["results"] == [
+        {"row": 1, "id": "4_590_A_300", "status": "ok"},
+        {"row": 2, "error": "write_error"},
+    ]
+    products = mock_database.bulk_upsert_products.call_args.args[0]
+    assert products[1].price_users == 7.5
+    assert products[1].quantity == 1
+
+
+def test_products_bulk_unknown_store(client, mock_database):
+    mock_database.get_store.return_value = None
+    response = client.post("/products/bulk?store_id=4", data="", content_type="application/x-ndjson")
+    assert json.loads(response.data) == {"error": "store_not_existing"}
+
+
+# ---------------------------
+# TEST /buy-product
+# ---------------------------
+def test_buy_product(client, mock_database):
+    mock_database.purchase.return_value = {"store_id": "s1", "store_points": 20, "user_points": 10}
 
     response = client.post("/buy-product", json={
         "code": "QR123",
@@ -110,6 +418,67 @@ def test_buy_product(client, mock_database):
     data = json.loads(response.data)
     assert response.status_code == 200
     assert data["status"] == "ok"
+    assert data["store_points"] == 20
+    assert data["users_points"] == 10
+    mock_database.purchase.assert_called_once_with("QR123", "p1", 2)
+
+
+def test_buy_product_not_enough_quantity(client, mock_database):
+    mock_database.purchase.return_value = {"error": "not_enough_quantity"}
+
+    response = client.post("/buy-product", json={
+        "code": "QR123",
+        "product_id": "p1",
+        "quantity": 200,
+        "store_id": "s1"
+    })
+    data = json.loads(response.data)
+    assert data["error"] == "not_enough_quantity"
+
+
+def test_buy_product_wrong_quantity(client, mock_database):
+    for body in [{"code": "QR123", "product_id": "p1", "quantity": "abc"}, {"code": "QR123", "product_id": "p1"}]:
+        response = client.post("/buy-product", json=body)
+        assert json.loads(response.data) == {"error": "wrong_quantity"}
+    mock_database.purchase.assert_not_called()
+
+
+# ---------------------------
+# TEST /checkout
+# ---------------------------
+def test_checkout(client, mock_database):
+    mock_database.checkout.return_value = {"stores": [{"store_id": 1, "store_points": 40}], "user_points": 12}
+
+    response = client.post("/checkout", json={
+        "code": "QR123",
+        "items": [{"product_id": "p1", "quantity": 2}, {"product_id": "p2", "quantity": 1},
+                  {"product_id": "p1", "quantity": 1}]
+    })
+    data = json.loads(response.data)
+    assert data["status"] == "ok"
+    assert data["users_points"] == 12
+    assert data["stores"] == [{"store_id": 1, "store_points": 40}]
+    mock_database.checkout.assert_called_once_with("QR123", {"p1": 3, "p2": 1})
+
+
+def test_checkout_wrong_items(client, mock_database):
+    for items in [[{"product_id": "p1"}], [{"product_id": "p1", "quantity": "two"}],
+                  [{"product_id": "p1", "quantity": [1]}], ["p1"], {"p1": 1},
+                  [{"product_id": ["p1"], "quantity": 1}], [{"product_id": {"id": "p1"}, "quantity": 1}],
+                  [{"quantity": 1}]]:
+        response = client.post("/checkout", json={"code": "QR123", "items": items})
+        assert response.status_code == 200
+        assert json.loads(response.data)["error"] == "wrong_quantity"
+    mock_database.checkout.assert_not_called()
+
+
+def test_checkout_wrong_input(client, mock_database):
+    response = client.post("/checkout", json={"code": "QR123", "items": []})
+    assert json.loads(response.data) == {"error": "empty_cart"}
+
+    response = client.post("/checkout", json={"code": "QR123", "items": [{"product_id": "p1", "quantity": 0}]})
+    assert json.loads(response.data) == {"error": "wrong_quantity", "product_id": "p1"}
+    mock_database.checkout.assert_not_called()
 
 
 # ---------------------------
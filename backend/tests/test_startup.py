@@ -0,0 +1,43 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parent.parent
+
+# seconds importing server may take on top of flask itself (about 0.03 s when this was written)
+IMPORT_BUDGET = 0.25
+HEAVY_MODULES = ["numpy", "pymongo", "geopy"]
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import flask, flask_cors
+flask_loaded = time.perf_counter()
+import server
+imported = time.perf_counter()
+app = server.create_app({"DB_URL" : "mongodb://localhost:1/"})
+created = time.perf_counter()
+print(json.dumps({
+    "import" : imported - flask_loaded,
+    "create_app" : created - imported,
+    "modules" : [m for m in %r if m in sys.modules]
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure():
+    # a fresh interpreter, so modules loaded by other tests do not count
+    output = subprocess.run([sys.executable, "-c", MEASURE], cwd=BACKEND, capture_output=True,
+                            text=True, timeout=60, check=True).stdout
+    return json.loads(output)
+
+
+# ---------------------------
+# TEST import server / create_app
+# ---------------------------
+def test_server_import_is_light():
+    result = measure()
+    assert result["modules"] == []
+    assert result["import"] < IMPORT_BUDGET
+    assert result["create_app"] < IMPORT_BUDGET
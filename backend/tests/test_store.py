@@ -0,0 +1,113 @@
+import pytest
+
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from classes.store import Store, StoresRanking, StoresRankings
+from classes.utils import Location
+
+
+# -------------------------------
+# FIXTURY
+# -------------------------------
+
+@pytest.fixture
+def stores():
+    return [
+        Store(1, "Biedronka", Location(52.23, 21.01, city="Warsaw", province="Masovian Voivodeship"), "p", 10),
+        Store(2, "Lidl", Location(50.06, 19.94, city="Kraków", province="Lesser Poland Voivodeship"), "p", 30),
+        Store(3, "Żabka", Location(51.40, 21.15, city="Radom", province="Masovian Voivodeship"), "p", 20),
+    ]
+
+
+@pytest.fixture
+def ranking(stores):
+    return StoresRanking(stores)
+
+
+# -------------------------------
+# TEST: get_ranking_list
+# -------------------------------
+def test_ranking_order(ranking):
+    result = ranking.get_ranking_list()
+    assert [r["store_id"] for r in result] == [2, 3, 1]
+    assert [r["place"] for r in result] == [1, 2, 3]
+    assert result[0]["coords"] == (50.06, 19.94)
+
+
+def test_ranking_page(ranking):
+    result = ranking.get_ranking_list(offset=1, limit=1)
+    assert len(result) == 1
+    assert result[0]["store_id"] == 3
+    assert result[0]["place"] == 2
+
+
+def test_ranking_page_negative_bounds(ranking):
+    result = ranking.get_ranking_list(offset=-1, limit=1)
+    assert [(r["store_id"], r["place"]) for r in result] == [(2, 1)]
+    assert ranking.get_ranking_list(limit=-1) == []
+
+
+# -------------------------------
+# TEST: update_points / get_rank
+# -------------------------------
+def test_update_points_moves_store(ranking, stores):
+    assert ranking.get_rank(1) == 3
+    ranking.update_points(1, 25)
+    assert ranking.get_rank(1) == 1
+    assert stores[0].get_points() == 35
+    assert [r["store_id"] for r in ranking.get_ranking_list()] == [1, 2, 3]
+
+
+def test_set_points_and_unknown_store(ranking):
+    ranking.set_points(2, 0)
+    assert ranking.get_rank(2) == 3
+    assert ranking.update_points(99, 5) == None
+    assert ranking.get_rank(99) == None
+
+
+def test_add_store(ranking):
+    ranking.add_to_end(Store(4, "Netto", Location(54.35, 18.65), "p"))
+    assert ranking.get_rank(4) == 4
+    assert len(ranking) == 4
+
+
+# -------------------------------
+# TEST: province
+# -------------------------------
+def test_province_ranking(stores):
+    ranking = StoresRanking(stores, "Masovian Voivodeship")
+    assert [r["store_id"] for r in ranking.get_ranking_list()] == [3, 1]
+
+
+def test_province_rankings_partitions(stores):
+    rankings = StoresRankings(stores)
+    assert [r["store_id"] for r in rankings.get().get_ranking_list()] == [2, 3, 1]
+    assert [r["store_id"] for r in rankings.get("mazowieckie").get_ranking_list()] == [3, 1]
+    assert rankings.get("lubuskie").get_ranking_list() == []
+
+
+def test_province_rankings_update_points(stores):
+    rankings = StoresRankings(stores)
+    rankings.update_points(1, 15)
+    assert rankings.get_rank(1) == 2
+    assert rankings.get_rank(1, "Masovian Voivodeship") == 1
+    assert rankings.get_rank(2, "małopolskie") == 1
+
+    rankings.add_store(Store(4, "Netto", Location(52.4, 20.9, city="Legionowo", province="Masovian Voivodeship"), "p", 100))
+    assert rankings.get_rank(4) == 1
+    assert rankings.get_rank(4, "mazowieckie") == 1
+
+
+# -------------------------------
+# TEST: compact objects
+# -------------------------------
+def test_stores_share_interned_location():
+    doc = {"id": 1, "name": "A", "location": [52.2, 21.0], "password": "p", "points": 5}
+    first = Store.from_database(doc)
+    second = Store.from_database(dict(doc, city="Warsaw", province="Masovian Voivodeship"))
+    assert first.location is second.location
+    assert first.location.get_city() == "Warsaw"
+    assert not hasattr(first, "__dict__")
+    assert not hasattr(first.location, "__dict__")